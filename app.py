@@ -1,30 +1,27 @@
+import hashlib
+import hmac
 import json
 import os
 import logging
 import re
-from datetime import datetime
-from textwrap import dedent
+import threading
+import time
 
-import requests
-import redis
 from flask import Flask, request
 from dotenv import load_dotenv
-from yandex_geocoder import Client, exceptions
-
-from shop import (
-    add_to_cart,
-    delete_cart_items,
-    get_cart_items,
-    get_cart_total_amount,
-    get_client_token_info,
-    get_products,
-    get_categories,
-    get_products_by_category,
-    get_product,
-    get_product_image,
-    get_pizzerias,
-    create_customer,
-)
+from yandex_geocoder import exceptions
+
+from cart_mirror import get_cart_mirror
+from catalog import fetch_catalog_snapshot
+from delivery import get_delivery_zones
+from fb_queue import enqueue_events, get_queue_stats, parse_messaging_events, run_workers
+from geocoder import get_geocoder
+from messenger import get_messenger_client
+from shop import connect_database, create_customer
+from pizzeria_registry import get_pizzeria_registry
+from request_cache import request_scope
+from session import load_fb_session
+from token_manager import get_token_manager
 from utilits import get_nearest_pizzeria
 
 load_dotenv()
@@ -33,6 +30,24 @@ app = Flask(__name__)
 
 DATABASE = None
 
+MENU_CACHE_TTL = 3600
+MENU_CACHE_REFRESH_INTERVAL = MENU_CACHE_TTL // 2
+
+IMAGE_URLS_LOCAL_TTL = 300
+
+# Prerendered carousels are spliced in as-is, so only the recipient id is
+# serialized per message.
+GENERIC_TEMPLATE_MESSAGE = (
+    '{"attachment": {"type": "template", '
+    '"payload": {"template_type": "generic", "elements": %s}}}'
+)
+
+FB_QUEUE_SHARDS = int(os.getenv("FB_QUEUE_SHARDS", 8))
+
+_menu_cache_warmer = None
+_product_image_urls = {}
+_product_image_urls_loaded_at = 0
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
@@ -56,70 +71,165 @@ def verify():
     return "Hello world", 200
 
 
+def is_valid_signature(payload, signature):
+    app_secret = os.getenv("APP_SECRET")
+    if not app_secret:
+        return True
+    expected_signature = "sha256=" + hmac.new(
+        app_secret.encode(), payload, hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(expected_signature, signature or "")
+
+
 @app.route("/", methods=["POST"])
 def webhook():
-    data = request.get_json()
-    if data["object"] == "page":
-        for entry in data["entry"]:
-            for messaging_event in entry["messaging"]:
-                if messaging_event.get("message"):
-                    sender_id = messaging_event["sender"]["id"]
-                    message_text = messaging_event["message"]["text"]
-                elif messaging_event.get("postback"):
-                    sender_id = messaging_event["sender"]["id"]
-                    message_text = messaging_event["postback"]["payload"]
-                handle_users_reply(sender_id, message_text)
+    if not is_valid_signature(request.get_data(), request.headers.get("X-Hub-Signature-256")):
+        return "Signature mismatch", 403
+
+    data = request.get_json(silent=True)
+    if not data or data.get("object") != "page":
+        return "Unsupported payload", 400
+
+    events = parse_messaging_events(data)
+    if events:
+        enqueue_events(get_database_connection(), events, FB_QUEUE_SHARDS)
 
     return "ok", 200
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return get_queue_stats(get_database_connection(), FB_QUEUE_SHARDS), 200
+
+
+@app.cli.command("fb-workers")
+def fb_workers_command():
+    workers = run_workers(get_database_connection(), handle_users_reply, FB_QUEUE_SHARDS)
+    for worker in workers:
+        worker.join()
+
+
 def set_menu_cache(access_token):
-    categories = get_categories(access_token)
+    started_at = time.monotonic()
+    snapshot = fetch_catalog_snapshot(access_token)
+    fetched_at = time.monotonic()
+
+    pipeline = DATABASE.pipeline()
+    pipeline.set("categories", json.dumps(snapshot.categories), ex=MENU_CACHE_TTL)
+    for category, products in snapshot.category_products.items():
+        pipeline.set(category, json.dumps(products), ex=MENU_CACHE_TTL)
+    pipeline.delete("product_image_urls")
+    if snapshot.image_urls:
+        pipeline.hmset("product_image_urls", snapshot.image_urls)
+        pipeline.expire("product_image_urls", MENU_CACHE_TTL)
+    pipeline.delete("menu_elements")
+    menu_elements = prerender_menu_elements(snapshot)
+    if menu_elements:
+        pipeline.hmset("menu_elements", menu_elements)
+        pipeline.expire("menu_elements", MENU_CACHE_TTL)
+    pipeline.execute()
+
+    finished_at = time.monotonic()
+    logger.info(
+        f"Menu cache warmed: {len(snapshot.products)} products, "
+        f"{len(snapshot.categories)} categories, fetch {fetched_at - started_at:.2f}s, "
+        f"redis {finished_at - fetched_at:.2f}s"
+    )
 
-    DATABASE.set("categories", json.dumps(categories))
+    return finished_at - started_at
+
+
+def refresh_menu_cache(min_ttl, blocking):
+    # TTL of a missing key is -2, so min_ttl=0 only fills a cold cache.
+    lock = DATABASE.lock("menu_cache_lock", timeout=120, blocking_timeout=120)
+    if not lock.acquire(blocking=blocking):
+        return
+    try:
+        if DATABASE.ttl("categories") < min_ttl:
+            set_menu_cache(get_access_token())
+    finally:
+        lock.release()
 
-    for category in categories:
-        category_products = json.dumps(get_products_by_category(access_token, category))
-        DATABASE.set(category, category_products)
 
-    product_image_urls = {}
-    products = get_products(access_token)
-    for product in products:
-        id = product["id"]
-        product_data = get_product(access_token, id)
-        product_image = get_product_image(access_token, product_data)
-        product_image_urls[id] = product_image
+def warm_menu_cache_forever():
+    while True:
+        try:
+            refresh_menu_cache(MENU_CACHE_REFRESH_INTERVAL, blocking=False)
+        except Exception as err:
+            logger.warning(f"Menu cache warmup failed: {err}")
+        time.sleep(60)
 
-    DATABASE.set("product_image_urls", json.dumps(product_image_urls))
+
+def start_menu_cache_warmer():
+    global _menu_cache_warmer
+    if _menu_cache_warmer is None:
+        _menu_cache_warmer = threading.Thread(target=warm_menu_cache_forever, daemon=True)
+        _menu_cache_warmer.start()
+
+
+@app.cli.command("warm-menu-cache")
+def warm_menu_cache_command():
+    get_database_connection()
+    elapsed = set_menu_cache(get_access_token())
+    print(f"Menu cache warmed in {elapsed:.2f}s")
 
 
 def get_category_menu_cache(category):
     return json.loads(DATABASE.get(category))
 
 
-def get_product_image_cache(product_id):
-    return json.loads(DATABASE.get("product_image_urls"))[product_id]
+def get_product_images_cache(product_ids):
+    global _product_image_urls, _product_image_urls_loaded_at
+    if time.monotonic() - _product_image_urls_loaded_at > IMAGE_URLS_LOCAL_TTL:
+        _product_image_urls = {}
+        _product_image_urls_loaded_at = time.monotonic()
+
+    missing_ids = [
+        product_id for product_id in dict.fromkeys(product_ids)
+        if product_id not in _product_image_urls
+    ]
+    if missing_ids:
+        image_urls = DATABASE.hmget("product_image_urls", missing_ids)
+        _product_image_urls.update(
+            (product_id, image_url)
+            for product_id, image_url in zip(missing_ids, image_urls)
+            if image_url is not None
+        )
+
+    return [_product_image_urls.get(product_id) for product_id in product_ids]
 
 
 def send_message(recipient_id, message_text):
-    params = {"access_token": os.getenv("PAGE_ACCESS_TOKEN")}
-    headers = {"Content-Type": "application/json"}
-    data = json.dumps(
-        {"recipient": {"id": recipient_id}, "message": {"text": message_text}}
-    )
-    response = requests.post(
-        "https://graph.facebook.com/v2.6/me/messages",
-        params=params,
-        headers=headers,
-        data=data,
-    )
-    response.raise_for_status()
+    get_messenger_client().send_text(recipient_id, message_text)
+
+
+def prerender_menu_elements(snapshot):
+    menu_elements = {}
+    for slug, products in snapshot.category_products.items():
+        product_images = [snapshot.image_urls.get(product["id"]) for product in products]
+        elements = build_menu_elements(slug, products, snapshot.categories, product_images)
+        menu_elements[slug] = json.dumps(elements)
+
+    return menu_elements
+
+
+def get_menu_elements_json(slug="basic"):
+    elements_json = DATABASE.hget("menu_elements", slug)
+    if elements_json is None:
+        elements_json = json.dumps(get_menu_elemets(slug))
+
+    return elements_json
 
 
 def get_menu_elemets(slug="basic"):
     products = get_category_menu_cache(slug)
     categories = json.loads(DATABASE.get("categories"))
+    product_images = get_product_images_cache([product["id"] for product in products])
+
+    return build_menu_elements(slug, products, categories, product_images)
 
+
+def build_menu_elements(slug, products, categories, product_images):
     elements = [
         {
             "title": "Меню",
@@ -145,12 +255,11 @@ def get_menu_elemets(slug="basic"):
         },
     ]
 
-    for product in products:
+    for product, product_image in zip(products, product_images):
         name = product["name"]
         price = int(product["price"][0]["amount"] / 100)
         description = product["description"]
         title = f"{name} ({price} р)"
-        product_image = get_product_image_cache(product["id"])
 
         elements.append(
             {
@@ -194,11 +303,9 @@ def get_menu_elemets(slug="basic"):
 
 def get_cart_menu_elements(sender_id, access_token):
     cart_id = f"facebookid_{sender_id}"
-    products = get_cart_items(access_token, cart_id)
+    products, cart = get_cart_mirror(DATABASE).get(access_token, cart_id)
 
-    cart_total_amount = get_cart_total_amount(access_token, cart_id)["meta"][
-        "display_price"
-    ]["with_tax"]["amount"]
+    cart_total_amount = cart["meta"]["display_price"]["with_tax"]["amount"]
 
     total_amount = int(int(cart_total_amount) / 100)
 
@@ -225,14 +332,14 @@ def get_cart_menu_elements(sender_id, access_token):
             ],
         },
     ]
-    for product in products:
+    product_images = get_product_images_cache([product["product_id"] for product in products])
+    for product, product_image in zip(products, product_images):
         name = product["name"]
         price = int(product["unit_price"]["amount"] / 100)
         description = product["description"]
         title = f"{name} ({price} р)"
         product_id = product["product_id"]
         cart_item_id = product["id"]
-        product_image = get_product_image_cache(product_id)
 
         elements.append(
             {
@@ -261,7 +368,7 @@ def add_product_to_cart(sender_id, message_text, access_token):
     product_id = product_info[-1]
     product_name = product_info[-2]
     cart_id = f"facebookid_{sender_id}"
-    add_to_cart(access_token, product_id, cart_id)
+    get_cart_mirror(DATABASE).add(access_token, cart_id, product_id)
     send_message(sender_id, f"Пицца {product_name} добавлена в корзину")
 
 
@@ -270,67 +377,49 @@ def remove_from_cart(sender_id, message_text, access_token):
     product_id = product_info[-1]
     product_name = product_info[-2]
     cart_id = f"facebookid_{sender_id}"
-    delete_cart_items(access_token, cart_id, product_id)
+    get_cart_mirror(DATABASE).remove(access_token, cart_id, product_id)
     send_message(sender_id, f"Пицца {product_name} удалена из корзины")
 
 
-def get_target_pizzeria(sender_id, address):
-    access_token = DATABASE.get("access_token")
+def get_customer_position(sender_id, address):
     yandex_token = os.getenv("YANDEX_TOKEN")
 
     try:
-        client = Client(yandex_token)
-        lon, lat = client.coordinates(address)
+        lon, lat = get_geocoder(DATABASE, yandex_token).coordinates(address)
         current_position = float(lat), float(lon)
     except exceptions.NothingFound:
         send_message(sender_id, "Не удалось определить координаты")
+        raise
+
+    return current_position
+
 
-    flow_slug = "pizzeria"
-    pizzerias = get_pizzerias(access_token, flow_slug)
+def get_target_pizzeria(sender_id, address):
+    current_position = get_customer_position(sender_id, address)
+    pizzerias = get_pizzeria_registry(DATABASE).get_index(get_access_token())
     pizzeria_address, distance = get_nearest_pizzeria(current_position, pizzerias)
 
     return pizzeria_address, distance
 
 
+def get_delivery_quote(sender_id, address):
+    current_position = get_customer_position(sender_id, address)
+    pizzerias = get_pizzeria_registry(DATABASE).get_index(get_access_token())
+
+    return get_delivery_zones(pizzerias).quote(current_position)
+
+
 def send_menu(sender_id, access_token, slug="basic", type="menu"):
     if type == "cart":
-        elements = get_cart_menu_elements(sender_id, access_token)
+        elements_json = json.dumps(get_cart_menu_elements(sender_id, access_token))
     elif type == "menu":
-        elements = get_menu_elemets(slug)
-    headers = {
-        "Content-Type": "application/json",
-    }
-
-    params = {
-        "access_token": os.getenv("PAGE_ACCESS_TOKEN"),
-    }
-
-    json_data = {
-        "recipient": {
-            "id": sender_id,
-        },
-        "message": {
-            "attachment": {
-                "type": "template",
-                "payload": {
-                    "template_type": "generic",
-                    "elements": elements,
-                },
-            },
-        },
-    }
+        elements_json = get_menu_elements_json(slug)
 
-    response = requests.post(
-        "https://graph.facebook.com/v2.6/me/messages",
-        params=params,
-        headers=headers,
-        json=json_data,
-    )
-    response.raise_for_status()
+    get_messenger_client().send(sender_id, GENERIC_TEMPLATE_MESSAGE % elements_json)
 
 
 def handle_start(sender_id, message_text):
-    access_token = DATABASE.get("access_token")
+    access_token = get_access_token()
 
     if "CATEGORY" in message_text:
         send_menu(sender_id, access_token, message_text.split("_")[-1])
@@ -342,7 +431,7 @@ def handle_start(sender_id, message_text):
 
 
 def handle_menu(sender_id, message_text):
-    access_token = DATABASE.get("access_token")
+    access_token = get_access_token()
 
     if message_text == "cart":
         send_menu(sender_id, access_token, type=message_text)
@@ -365,7 +454,7 @@ def handle_menu(sender_id, message_text):
 
 
 def handle_cart(sender_id, message_text):
-    access_token = DATABASE.get("access_token")
+    access_token = get_access_token()
 
     if message_text == "menu":
         send_menu(sender_id, access_token, type=message_text)
@@ -406,38 +495,9 @@ def handle_pickup(sender_id, message_text):
 
 
 def handle_delivery(sender_id, message_text):
-    pizzeria_address, distance = get_target_pizzeria(sender_id, message_text)
-    if distance <= 0.5:
-        message = f"""
-        Может, заберете пиццу из нашей пиццерии неподалеку?
-
-        Она всего в {(distance):.2f} метрах от Вас!
-        Вот её адрес: {pizzeria_address}.
-
-        А можем и бесплатно оставить, нам не сложно))
-        """
-    elif 0.5 < distance <= 5:
-        message = f"""
-        Доставим Вашу пиццу за 100 рублей.
-
-        Или можете забрать ее по адресу: {pizzeria_address}
-        """
-    elif 5 < distance <= 20:
-        message = f"""
-        Доставим Вашу пиццу за 300 рублей.
-
-        Или можете забрать ее по адресу: {pizzeria_address}
-        """
-    else:
-        message = f"""
-        Простите, но так далеко мы пиццу не доставим.
+    quote = get_delivery_quote(sender_id, message_text)
 
-        Ближайшая пиццерия аж в {distance:.2f} километрах от Вас.
-
-        Заезжайте к нам в гости: {pizzeria_address}
-        """
-
-    send_message(sender_id, dedent(message))
+    send_message(sender_id, quote.get_message())
 
     send_message(sender_id, "Для завершения заказа пришлите свой email")
 
@@ -445,7 +505,7 @@ def handle_delivery(sender_id, message_text):
 
 
 def handle_email(sender_id, message_text):
-    access_token = DATABASE.get("access_token")
+    access_token = get_access_token()
     username = f"facebookid_{sender_id}"
 
     if re.search(r"^\w+@\w+\.\w+$", message_text):
@@ -459,26 +519,12 @@ def handle_email(sender_id, message_text):
 
 
 def handle_users_reply(sender_id, message_text):
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
-    grant_type = os.getenv("GRANT_TYPE")
-
     db = get_database_connection()
 
-    if db.get("token_timestamp"):
-        diff = datetime.timestamp(datetime.now()) - float(db.get("token_timestamp"))
-        client_token_info = get_client_token_info(client_id, client_secret, grant_type)
-        expires_time = client_token_info["expires_in"]
-        if diff >= expires_time:
-            access_token = client_token_info["access_token"]
-            db.set("token_timestamp", datetime.timestamp(datetime.now()))
-            db.set("access_token", access_token)
-            set_menu_cache(access_token)
-    else:
-        db.set("token_timestamp", datetime.timestamp(datetime.now()))
-        client_token_info = get_client_token_info(client_id, client_secret, grant_type)
-        db.set("access_token", client_token_info["access_token"])
-        set_menu_cache(access_token)
+    start_menu_cache_warmer()
+    if not db.exists("categories"):
+        # Wait for whoever holds the lock instead of fetching the catalog again.
+        refresh_menu_cache(0, blocking=True)
 
     states_functions = {
         "START": handle_start,
@@ -489,7 +535,8 @@ def handle_users_reply(sender_id, message_text):
         "EMAIL": handle_email,
     }
 
-    recorded_state = db.get(f"facebookid_{sender_id}")
+    session = load_fb_session(db, sender_id)
+    recorded_state = session.get("state")
     if not recorded_state or recorded_state not in states_functions.keys():
         user_state = "START"
     else:
@@ -498,21 +545,30 @@ def handle_users_reply(sender_id, message_text):
         user_state = "START"
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(sender_id, message_text)
-        db.set(f"facebookid_{sender_id}", next_state)
+        # Everything a handler sends goes out in one batch after it returns.
+        with get_messenger_client().outbox(sender_id), \
+                request_scope(f"Message from {sender_id}"):
+            next_state = state_handler(sender_id, message_text)
+        session["state"] = next_state
+        session.save()
     except Exception as err:
         error(user_state, err)
 
 
+def get_access_token():
+    token_manager = get_token_manager(
+        get_database_connection(),
+        os.getenv("CLIENT_ID"),
+        os.getenv("CLIENT_SECRET"),
+        os.getenv("GRANT_TYPE"),
+    )
+    return token_manager.get_access_token()
+
+
 def get_database_connection():
     global DATABASE
     if DATABASE is None:
-        DATABASE = redis.Redis(
-            host=os.getenv("DATABASE_HOST"),
-            port=os.getenv("DATABASE_PORT"),
-            password=os.getenv("DATABASE_PASSWORD"),
-            decode_responses=True,
-        )
+        DATABASE = connect_database()
     return DATABASE
 
 
@@ -0,0 +1,327 @@
+import asyncio
+import os
+import threading
+
+import httpx
+
+from request_cache import (
+    async_invalidates,
+    async_memoized,
+    get_request_cache,
+    set_request_cache,
+)
+from shop import (
+    MOLTIN_API_URL,
+    file_link_cache,
+    get_product_json_data,
+    parse_categories,
+    parse_pizzerias_location,
+)
+
+
+_async_client = None
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever,
+                    name="moltin-async-loop",
+                    daemon=True,
+                ).start()
+                _loop = loop
+    return _loop
+
+
+def run(coroutine):
+    # Lets the synchronous bot handlers await the async API: every coroutine
+    # runs on one background loop, so the shared AsyncClient and its
+    # connection pool are never bound to more than one event loop.
+    return asyncio.run_coroutine_threadsafe(
+        in_request_scope(coroutine, get_request_cache()),
+        get_event_loop(),
+    ).result()
+
+
+async def in_request_scope(coroutine, cache):
+    # The loop thread has its own context, so the caller's request cache is
+    # carried over explicitly; tasks spawned from here inherit it.
+    set_request_cache(cache)
+    return await coroutine
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        pool_size = int(os.getenv("MOLTIN_POOL_SIZE", 10))
+        _async_client = httpx.AsyncClient(
+            base_url=os.getenv("MOLTIN_API_URL", MOLTIN_API_URL).rstrip("/"),
+            headers={"Accept": "application/json"},
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+            ),
+            timeout=httpx.Timeout(15, connect=3.05),
+        )
+    return _async_client
+
+
+async def request(method, path, token=None, auth_scheme="Bearer", **kwargs):
+    headers = kwargs.pop("headers", {})
+    if token:
+        headers["Authorization"] = f"{auth_scheme} {token}" if auth_scheme else f"{token}"
+
+    response = await get_async_client().request(method, path, headers=headers, **kwargs)
+    response.raise_for_status()
+
+    return response
+
+
+async def get_client_token_info(client_id, client_secret, grant_type):
+    data = {
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "grant_type": grant_type,
+    }
+
+    response = await request("POST", "/oauth/access_token", data=data)
+
+    return response.json()
+
+
+async def upload_product_image(token, image_url):
+    files = {
+        "file_location": (None, image_url),
+    }
+    response = await request("POST", "/v2/files", token, files=files)
+
+    return response.json()["data"]["id"]
+
+
+async def add_product_image(token, product_id, image_id):
+    json_data = {
+        "data": {
+            "type": "main_image",
+            "id": image_id,
+        },
+    }
+    await request(
+        "POST",
+        f"/v2/products/{product_id}/relationships/main-image",
+        token,
+        json=json_data,
+    )
+
+
+async def create_product(token, product):
+    response = await request(
+        "POST", "/v2/products", token, json=get_product_json_data(product)
+    )
+    stored_product_id = response.json()["data"]["id"]
+    product_image_id = await upload_product_image(token, product.image_url)
+
+    await add_product_image(token, stored_product_id, product_image_id)
+
+
+@async_memoized
+async def get_products(token):
+    response = await request("GET", "/v2/products/", token)
+
+    return response.json()["data"]
+
+
+@async_memoized
+async def get_products_by_category(token, slug="basic"):
+    categories = await get_categories(token)
+    category_id = categories[slug]["id"]
+
+    params = {
+        "filter": f"eq(category.id,{category_id})",
+    }
+
+    response = await request("GET", "/v2/products", token, params=params)
+
+    return response.json()["data"]
+
+
+@async_memoized
+async def get_product(token, product_id):
+    response = await request("GET", f"/v2/products/{product_id}", token)
+
+    return response.json()["data"]
+
+
+async def get_product_image(token, product_data):
+    image_id = product_data["relationships"]["main_image"]["data"]["id"]
+
+    links = await get_file_links(token, [image_id])
+
+    return links[image_id]
+
+
+@async_invalidates
+async def add_to_cart(token, product_id, cart_id, quantity=1):
+    json_data = {
+        "data": {
+            "id": product_id,
+            "type": "cart_item",
+            "quantity": quantity,
+        },
+    }
+
+    response = await request("POST", f"/v2/carts/{cart_id}/items", token, json=json_data)
+
+    return response.json()
+
+
+@async_memoized
+async def get_cart_items(token, cart_id):
+    response = await request("GET", f"/v2/carts/{cart_id}/items", token)
+
+    return response.json()["data"]
+
+
+@async_memoized
+async def get_cart_total_amount(token, cart_id):
+    response = await request("GET", f"/v2/carts/{cart_id}", token)
+
+    return response.json()["data"]
+
+
+@async_invalidates
+async def delete_cart_items(token, cart_id, item_id):
+    response = await request("DELETE", f"/v2/carts/{cart_id}/items/{item_id}", token)
+
+    return response.json()
+
+
+async def create_customer(token, user_name, email):
+    json_data = {
+        "data": {
+            "type": "customer",
+            "name": user_name,
+            "email": email,
+        },
+    }
+
+    await request("POST", "/v2/customers", token, json=json_data)
+
+
+@async_memoized
+async def get_pizzerias(token, flow_slug, page_limit=100, concurrency=5):
+    async def fetch_page(offset):
+        params = {"page[limit]": page_limit, "page[offset]": offset}
+        async with semaphore:
+            response = await request("GET", f"/v2/flows/{flow_slug}/entries", token, params=params)
+        return response.json()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    first_page = await fetch_page(0)
+    total = first_page.get("meta", {}).get("results", {}).get("total", 0)
+    pages = [first_page]
+    if first_page["data"]:
+        pages += await asyncio.gather(*[
+            fetch_page(offset) for offset in range(page_limit, total, page_limit)
+        ])
+
+    return parse_pizzerias_location({"data": [entry for page in pages for entry in page["data"]]})
+
+
+@async_memoized
+async def get_categories(token):
+    response = await request("GET", "/v2/categories", token)
+
+    return parse_categories(response.json())
+
+
+async def get_cart_with_total(token, cart_id):
+    cart_items, cart_total_amount = await asyncio.gather(
+        get_cart_items(token, cart_id),
+        get_cart_total_amount(token, cart_id),
+    )
+
+    return cart_items, cart_total_amount
+
+
+async def get_products_with_images(token, page_limit=100, concurrency=5):
+    async def fetch_page(offset):
+        params = {
+            "include": "main_image",
+            "page[limit]": page_limit,
+            "page[offset]": offset,
+        }
+        async with semaphore:
+            response = await request("GET", "/v2/products", token, params=params)
+        return response.json()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    first_page = await fetch_page(0)
+    total = first_page.get("meta", {}).get("results", {}).get("total", 0)
+    pages = [first_page]
+    if first_page["data"]:
+        pages += await asyncio.gather(*[
+            fetch_page(offset) for offset in range(page_limit, total, page_limit)
+        ])
+
+    products = []
+    image_urls = {}
+    for page in pages:
+        products.extend(page["data"])
+        for image in page.get("included", {}).get("main_images", []):
+            image_urls[image["id"]] = image["link"]["href"]
+
+    return products, image_urls
+
+
+async def get_file_links(token, file_ids, batch_size=50, concurrency=5):
+    semaphore = asyncio.Semaphore(concurrency)
+    file_ids = list(dict.fromkeys(file_ids))
+    links = file_link_cache.get_many(file_ids)
+    missing_file_ids = [file_id for file_id in file_ids if file_id not in links]
+
+    async def fetch_batch(batch):
+        params = {"filter": f"in(id,{','.join(batch)})"}
+        async with semaphore:
+            response = await request("GET", "/v2/files", token, params=params)
+        return response.json()["data"]
+
+    batches = await asyncio.gather(*[
+        fetch_batch(missing_file_ids[start:start + batch_size])
+        for start in range(0, len(missing_file_ids), batch_size)
+    ])
+    fetched_links = {file["id"]: file["link"]["href"] for batch in batches for file in batch}
+    file_link_cache.update(fetched_links)
+    links.update(fetched_links)
+
+    return links
+
+
+async def get_catalog_data(token):
+    (products, file_urls), categories = await asyncio.gather(
+        get_products_with_images(token),
+        get_categories(token),
+    )
+
+    image_ids = {
+        product["id"]: product["relationships"]["main_image"]["data"]["id"]
+        for product in products
+        if product.get("relationships", {}).get("main_image")
+    }
+    file_link_cache.update(file_urls)
+    missing_file_ids = set(image_ids.values()) - set(file_urls)
+    if missing_file_ids:
+        file_urls.update(await get_file_links(token, missing_file_ids))
+
+    image_urls = {
+        product_id: file_urls[image_id]
+        for product_id, image_id in image_ids.items()
+        if image_id in file_urls
+    }
+
+    return products, categories, image_urls
@@ -0,0 +1,370 @@
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+
+import redis
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import app
+import tg_bot
+from benchmarks.fake_servers import (FakeGraphServer,
+                                     FakeMoltinServer,
+                                     FakeTelegramServer,
+                                     FakeYandexGeocoderServer)
+from session import load_fb_session, load_tg_session
+from tg_workers import create_dispatcher
+
+
+TG_TOKEN = "123456:benchmark"
+CLIENT_ID = "benchmark"
+CLIENT_SECRET = "benchmark"
+GRANT_TYPE = "client_credentials"
+YANDEX_TOKEN = "benchmark"
+
+PIZZERIAS = [
+    ("tverskaya", "Москва, Тверская улица, 1", 55.7577, 37.6136),
+    ("arbat", "Москва, улица Арбат, 20", 55.7500, 37.5930),
+    ("taganka", "Москва, Таганская улица, 3", 55.7390, 37.6590),
+]
+
+SERVERS = ("moltin", "graph", "telegram", "geocoder")
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# Most external calls a single step may make, per server. A step that is
+# missing here may not call anything. Raise a number only together with the
+# change that needs the extra round trip.
+BUDGETS = {
+    ("tg", "START", "/start"): {"telegram": 1},
+    ("tg", "HANDLE_MENU", "next page"): {"telegram": 1},
+    ("tg", "HANDLE_MENU", "product"): {"telegram": 2},
+    ("tg", "HANDLE_MENU", "cart"): {"telegram": 2},
+    ("tg", "HANDLE_DESCRIPTION", "add to cart"): {"moltin": 1, "telegram": 1},
+    ("tg", "HANDLE_DESCRIPTION", "back"): {"telegram": 2},
+    ("tg", "HANDLE_DESCRIPTION", "cart"): {"telegram": 2},
+    ("tg", "HANDLE_CART", "remove"): {"moltin": 1, "telegram": 2},
+    ("tg", "HANDLE_CART", "menu"): {"telegram": 2},
+    ("tg", "HANDLE_CART", "pay"): {"telegram": 1},
+    ("tg", "HANDLE_WAITING", "address"): {"geocoder": 1, "telegram": 1},
+    ("tg", "HANDLE_WAITING", "location"): {"telegram": 1},
+    ("tg", "HANDLE_DELIVERY", "courier"): {"telegram": 2},
+    ("tg", "HANDLE_DELIVERY", "pickup"): {"telegram": 1},
+    ("fb", "START", "/start"): {"graph": 1},
+    ("fb", "MENU", "category"): {"graph": 1},
+    ("fb", "MENU", "add to cart"): {"moltin": 1, "graph": 1},
+    ("fb", "MENU", "cart"): {"graph": 1},
+    ("fb", "CART", "add"): {"moltin": 1, "graph": 1},
+    ("fb", "CART", "remove"): {"moltin": 1, "graph": 1},
+    ("fb", "CART", "menu"): {"graph": 1},
+    ("fb", "CART", "delivery"): {"graph": 1},
+    ("fb", "CART", "pickup"): {"graph": 1},
+    ("fb", "DELIVERY", "address"): {"geocoder": 1, "graph": 1},
+    ("fb", "PICKUP", "address"): {"geocoder": 1, "graph": 1},
+    ("fb", "EMAIL", "invalid email"): {"graph": 1},
+    ("fb", "EMAIL", "email"): {"moltin": 1, "graph": 1},
+}
+
+
+def message_update(bot, update_id, chat_id, text=None, location=None):
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "benchmark"},
+    }
+    if text is not None:
+        message["text"] = text
+    if location is not None:
+        message["location"] = {"latitude": location[0], "longitude": location[1]}
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def callback_update(bot, update_id, chat_id, data):
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "benchmark"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+            },
+        },
+    }, bot)
+
+
+def get_cart_item_ids(moltin, cart_id):
+    return list(moltin.carts.get(str(cart_id), {}))
+
+
+def tg_conversation(moltin, number, address, position):
+    # Each step is (state, action, reply, expected next state); replies that
+    # depend on earlier steps (cart item ids) are callables.
+    products = list(moltin.products.values())
+    first, second = products[number % len(products)], products[(number + 1) % len(products)]
+    steps = [
+        ("START", "/start", "/start", "HANDLE_MENU"),
+        ("HANDLE_MENU", "next page", "pag, 1", "HANDLE_MENU"),
+        ("HANDLE_MENU", "product", first["id"], "HANDLE_DESCRIPTION"),
+        ("HANDLE_DESCRIPTION", "add to cart", "1", "HANDLE_DESCRIPTION"),
+        ("HANDLE_DESCRIPTION", "back", "back", "HANDLE_MENU"),
+        ("HANDLE_MENU", "product", second["id"], "HANDLE_DESCRIPTION"),
+        ("HANDLE_DESCRIPTION", "add to cart", "2", "HANDLE_DESCRIPTION"),
+        ("HANDLE_DESCRIPTION", "cart", "cart", "HANDLE_CART"),
+        ("HANDLE_CART", "remove", lambda chat_id: f"del {get_cart_item_ids(moltin, chat_id)[0]}",
+         "HANDLE_CART"),
+        ("HANDLE_CART", "menu", "menu", "HANDLE_MENU"),
+        ("HANDLE_MENU", "cart", "cart", "HANDLE_CART"),
+        ("HANDLE_CART", "pay", "pay, 600", "HANDLE_WAITING"),
+    ]
+    if number % 2:
+        steps += [
+            ("HANDLE_WAITING", "address", address, "HANDLE_DELIVERY"),
+            ("HANDLE_DELIVERY", "courier",
+             lambda chat_id: json.dumps([chat_id, list(position)]), "END"),
+        ]
+    else:
+        steps += [
+            ("HANDLE_WAITING", "location", position, "HANDLE_DELIVERY"),
+            ("HANDLE_DELIVERY", "pickup", "pickup", "END"),
+        ]
+    return steps
+
+
+def fb_conversation(moltin, number, address):
+    products = list(moltin.products.values())
+    first, second = products[number % len(products)], products[(number + 1) % len(products)]
+    category = moltin.categories[-1]["slug"]
+    sender_id = str(number)
+
+    def remove_first_item(sender_id):
+        item_id = get_cart_item_ids(moltin, f"facebookid_{sender_id}")[0]
+        return f"REMOVE_{first['name']}_{item_id}"
+
+    steps = [
+        ("START", "/start", "/start", "MENU"),
+        ("MENU", "category", f"CATEGORY_{category}", "MENU"),
+        ("MENU", "add to cart", f"ADD_{first['name']}_{first['id']}", "MENU"),
+        ("MENU", "cart", "cart", "CART"),
+        ("CART", "add", f"ADD_{second['name']}_{second['id']}", "CART"),
+        ("CART", "remove", remove_first_item, "CART"),
+        ("CART", "menu", "menu", "MENU"),
+        ("MENU", "cart", "cart", "CART"),
+    ]
+    if number % 2:
+        steps += [
+            ("CART", "delivery", "delivery", "DELIVERY"),
+            ("DELIVERY", "address", address, "EMAIL"),
+        ]
+    else:
+        steps += [
+            ("CART", "pickup", "pickup", "PICKUP"),
+            ("PICKUP", "address", address, "EMAIL"),
+        ]
+    steps += [
+        ("EMAIL", "invalid email", "not an email", "EMAIL"),
+        ("EMAIL", "email", f"user{sender_id}@example.com", "START"),
+    ]
+    return sender_id, steps
+
+
+class Harness:
+    def __init__(self, database, servers, dispatcher):
+        self.database = database
+        self.servers = servers
+        self.dispatcher = dispatcher
+        self.update_ids = 0
+        self.timings = defaultdict(list)
+        self.calls = defaultdict(Counter)
+        self.record = True
+
+    def count_calls(self):
+        return {name: sum(server.calls.values()) for name, server in self.servers.items()}
+
+    def measure(self, key, handle):
+        calls_before = self.count_calls()
+        started_at = time.perf_counter()
+        handle()
+        elapsed = (time.perf_counter() - started_at) * 1000
+        calls_after = self.count_calls()
+        if not self.record:
+            return
+        self.timings[key].append(elapsed)
+        for name in SERVERS:
+            calls = calls_after[name] - calls_before[name]
+            self.calls[key][name] = max(self.calls[key][name], calls)
+
+    def next_update_id(self):
+        self.update_ids += 1
+        return self.update_ids
+
+    def run_tg(self, chat_id, steps):
+        bot = self.dispatcher.bot
+        for state, action, reply, next_state in steps:
+            if callable(reply):
+                reply = reply(chat_id)
+            if state in ("START", "HANDLE_WAITING"):
+                if isinstance(reply, tuple):
+                    update = message_update(bot, self.next_update_id(), chat_id, location=reply)
+                else:
+                    update = message_update(bot, self.next_update_id(), chat_id, text=reply)
+            else:
+                update = callback_update(bot, self.next_update_id(), chat_id, reply)
+            context = CallbackContext.from_update(update, self.dispatcher)
+
+            self.measure(("tg", state, action), lambda: tg_bot.handle_users_reply(
+                update, context, CLIENT_ID, CLIENT_SECRET, GRANT_TYPE, YANDEX_TOKEN
+            ))
+            reached_state = load_tg_session(self.database, chat_id).get("state")
+            assert reached_state == next_state, \
+                f"tg {state} {action!r} went to {reached_state}, expected {next_state}"
+
+    def run_fb(self, sender_id, steps):
+        for state, action, reply, next_state in steps:
+            if callable(reply):
+                reply = reply(sender_id)
+
+            self.measure(("fb", state, action), lambda: app.handle_users_reply(sender_id, reply))
+            reached_state = load_fb_session(self.database, sender_id).get("state")
+            assert reached_state == next_state, \
+                f"fb {state} {action!r} went to {reached_state}, expected {next_state}"
+
+
+def report(harness):
+    print(f"{'bot':<3} {'state':<19} {'action':<14} {'steps':>5} {'p50 ms':>8} {'p99 ms':>8}  "
+          + "  ".join(f"{name:>8}" for name in SERVERS))
+    # Rows follow the conversations through the states, as BUDGETS does.
+    order = {key: position for position, key in enumerate(BUDGETS)}
+    for key in sorted(harness.timings, key=lambda key: order.get(key, len(order))):
+        timings = sorted(harness.timings[key])
+        p50 = statistics.median(timings)
+        p99 = timings[min(len(timings) - 1, math.ceil(len(timings) * 0.99) - 1)]
+        bot, state, action = key
+        print(f"{bot:<3} {state:<19} {action:<14} {len(timings):>5} {p50:>8.2f} {p99:>8.2f}  "
+              + "  ".join(f"{harness.calls[key][name]:>8}" for name in SERVERS))
+
+
+def check_budgets(harness):
+    exceeded = []
+    for key, calls in harness.calls.items():
+        budget = BUDGETS.get(key, {})
+        for name in SERVERS:
+            if calls[name] > budget.get(name, 0):
+                exceeded.append(f"{' '.join(key)}: {calls[name]} {name} calls, budget {budget.get(name, 0)}")
+    return exceeded
+
+
+def connect_database(db, allow_flush):
+    host = os.getenv("DATABASE_HOST") or "localhost"
+    # The scratch database is flushed, so a shared Redis from .env is only
+    # used when asked for explicitly.
+    if host not in LOCAL_HOSTS and not allow_flush:
+        sys.exit(
+            f"Refusing to flush database {db} on {host}; "
+            f"run against a local Redis or pass --flush"
+        )
+    database = redis.Redis(
+        host=host,
+        port=os.getenv("DATABASE_PORT") or 6379,
+        password=os.getenv("DATABASE_PASSWORD"),
+        db=db,
+        decode_responses=True,
+    )
+    database.flushdb()
+    return database
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-state latency and external calls of both bots against fake servers"
+    )
+    parser.add_argument("--conversations", type=int, default=50, help="per bot")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured conversations per bot")
+    parser.add_argument("--latency", type=float, default=0.005, help="fake server latency, seconds")
+    parser.add_argument("--moltin-latency", type=float)
+    parser.add_argument("--graph-latency", type=float)
+    parser.add_argument("--telegram-latency", type=float)
+    parser.add_argument("--geocoder-latency", type=float)
+    parser.add_argument("--redis-db", type=int, default=15,
+                        help="scratch Redis database, flushed before the run")
+    parser.add_argument("--flush", action="store_true",
+                        help="allow flushing --redis-db on a Redis that is not on localhost")
+    parser.add_argument("--no-budgets", action="store_true", help="report only, do not fail")
+    args = parser.parse_args()
+
+    def latency(server_latency):
+        return args.latency if server_latency is None else server_latency
+
+    conversations = args.warmup + args.conversations
+    # Every conversation geocodes its own address, so the geocoder cache
+    # does not hide the lookup.
+    addresses = {}
+    for number in range(conversations):
+        _, _, lat, lon = PIZZERIAS[number % len(PIZZERIAS)]
+        for bot in ("tg", "fb"):
+            addresses[f"Москва, улица Бенчмарка, {number}, {bot}"] = (lat + 0.002, lon + 0.002)
+
+    database = connect_database(args.redis_db, args.flush)
+    servers = {
+        "moltin": FakeMoltinServer(pizzerias=PIZZERIAS, latency=latency(args.moltin_latency)),
+        "graph": FakeGraphServer(latency=latency(args.graph_latency)),
+        "telegram": FakeTelegramServer(latency=latency(args.telegram_latency)),
+        "geocoder": FakeYandexGeocoderServer(addresses, latency=latency(args.geocoder_latency)),
+    }
+    for server in servers.values():
+        server.start()
+    os.environ["MOLTIN_API_URL"] = servers["moltin"].url
+    os.environ["GRAPH_API_URL"] = servers["graph"].url
+    os.environ["YANDEX_GEOCODER_URL"] = f"{servers['geocoder'].url}/1.x/"
+    os.environ["PAGE_ACCESS_TOKEN"] = "benchmark"
+    os.environ["CLIENT_ID"] = CLIENT_ID
+    os.environ["CLIENT_SECRET"] = CLIENT_SECRET
+    os.environ["GRANT_TYPE"] = GRANT_TYPE
+    os.environ["YANDEX_TOKEN"] = YANDEX_TOKEN
+
+    app.DATABASE = database
+    tg_bot._database = database
+    dispatcher = create_dispatcher(TG_TOKEN, 1, base_url=f"{servers['telegram'].url}/bot")
+    harness = Harness(database, servers, dispatcher)
+
+    try:
+        for number in range(conversations):
+            harness.record = number >= args.warmup
+            _, _, lat, lon = PIZZERIAS[number % len(PIZZERIAS)]
+            position = (lat + 0.001, lon + 0.001)
+            harness.run_tg(1000 + number, tg_conversation(
+                servers["moltin"], number, f"Москва, улица Бенчмарка, {number}, tg", position
+            ))
+            harness.run_fb(*fb_conversation(
+                servers["moltin"], number, f"Москва, улица Бенчмарка, {number}, fb"
+            ))
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    print(f"{args.conversations} conversations per bot after {args.warmup} warmup, "
+          f"fake server latency {args.latency * 1000:.0f} ms; calls are the most made by one step")
+    report(harness)
+
+    if args.no_budgets:
+        return
+    exceeded = check_budgets(harness)
+    if exceeded:
+        print("\nCall budgets exceeded:")
+        for line in exceeded:
+            print(f"  {line}")
+        sys.exit(1)
+    print("\nAll steps are within their call budgets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import os
+import time
+
+from benchmarks.fake_servers import FakeMoltinServer
+from catalog import fetch_catalog_snapshot
+from shop import get_categories, get_product, get_product_image, get_products, get_products_by_category
+
+
+def legacy_fetch(access_token):
+    categories = get_categories(access_token)
+    category_products = {
+        category: get_products_by_category(access_token, category)
+        for category in categories
+    }
+    product_image_urls = {}
+    for product in get_products(access_token):
+        product_data = get_product(access_token, product["id"])
+        product_image_urls[product["id"]] = get_product_image(access_token, product_data)
+    return categories, category_products, product_image_urls
+
+
+def pipelined_fetch(access_token):
+    snapshot = fetch_catalog_snapshot(access_token)
+    return snapshot.categories, snapshot.category_products, snapshot.image_urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Menu cache warmup: sequential vs pipelined")
+    parser.add_argument("--products", type=int, default=36)
+    parser.add_argument("--categories", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.02, help="fake server latency, seconds")
+    args = parser.parse_args()
+
+    with FakeMoltinServer(
+        products=args.products,
+        categories=args.categories,
+        latency=args.latency,
+    ) as server:
+        os.environ["MOLTIN_API_URL"] = server.url
+        for title, fetch in [("sequential (legacy)", legacy_fetch), ("pipelined", pipelined_fetch)]:
+            server.reset_stats()
+            started_at = time.perf_counter()
+            categories, category_products, image_urls = fetch("token")
+            elapsed = time.perf_counter() - started_at
+            print(
+                f"{title:<22} {elapsed:6.2f}s  {sum(server.calls.values()):4d} requests  "
+                f"{len(image_urls)} images, {len(categories)} categories"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import json
+import os
+import timeit
+
+from benchmarks.fake_servers import FakeMoltinServer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Facebook menu carousel: build per message vs prerendered splice"
+    )
+    parser.add_argument("--products", type=int, default=30)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    with FakeMoltinServer(products=args.products) as server:
+        os.environ["MOLTIN_API_URL"] = server.url
+        from app import GENERIC_TEMPLATE_MESSAGE, build_menu_elements, prerender_menu_elements
+        from catalog import fetch_catalog_snapshot
+
+        snapshot = fetch_catalog_snapshot("token")
+
+    slug = "basic"
+    # What the build path reads back from Redis on every message.
+    stored_products = json.dumps(snapshot.category_products[slug])
+    stored_categories = json.dumps(snapshot.categories)
+    stored_image_urls = dict(snapshot.image_urls)
+    prerendered = prerender_menu_elements(snapshot)[slug]
+
+    def build_per_message():
+        products = json.loads(stored_products)
+        categories = json.loads(stored_categories)
+        product_images = [stored_image_urls.get(product["id"]) for product in products]
+        elements = build_menu_elements(slug, products, categories, product_images)
+        return json.dumps({
+            "attachment": {
+                "type": "template",
+                "payload": {"template_type": "generic", "elements": elements},
+            },
+        })
+
+    def splice_prerendered():
+        return GENERIC_TEMPLATE_MESSAGE % prerendered
+
+    assert json.loads(build_per_message()) == json.loads(splice_prerendered())
+
+    for title, render in [("build per message", build_per_message), ("prerendered splice", splice_prerendered)]:
+        elapsed = timeit.timeit(render, number=args.number)
+        print(f"{title:<20} {elapsed / args.number * 1e6:8.1f} us per message")
+    print("Redis round trips (not timed): build 3 (GET, GET, HMGET), prerendered 1 (HGET)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from menu_loader import MENU_PATH, iter_menu
+
+
+def write_synthetic_menu(path, items):
+    with open(MENU_PATH, "r") as fin:
+        templates = json.load(fin)
+    with open(path, "w") as fout:
+        fout.write("[")
+        for number in range(items):
+            item = dict(templates[number % len(templates)], id=number)
+            fout.write(("," if number else "") + json.dumps(item, ensure_ascii=False))
+        fout.write("]")
+
+
+def measure(title, load):
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    items = load()
+    elapsed = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{title:<28} {items:>8}  {elapsed:>7.2f}s  {peak / 2 ** 20:>9.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Menu loading: json.load vs streaming records")
+    parser.add_argument("--items", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "menu.json")
+        write_synthetic_menu(path, args.items)
+        print(f"Synthetic menu: {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+        print(f"{'loader':<28} {'items':>8}  {'time':>8}  {'peak memory':>13}")
+
+        def load_json():
+            with open(path, "r") as fin:
+                return len(json.load(fin))
+
+        measure("json.load, dicts", load_json)
+        measure("records, materialized", lambda: len(list(iter_menu(path))))
+        measure("records, streamed", lambda: sum(1 for _ in iter_menu(path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import math
+import statistics
+import time
+
+import requests
+
+from benchmarks.fake_servers import FakeMoltinServer
+from shop import MoltinClient
+
+
+def measure(call, calls):
+    timings = []
+    for _ in range(calls):
+        started_at = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started_at) * 1000)
+    return timings
+
+
+def report(title, timings, connections):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, math.ceil(len(timings) * 0.99) - 1)]
+    print(f"{title:<28} p50 {p50:7.3f} ms   p99 {p99:7.3f} ms   connections {connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Moltin per-call latency with and without MoltinClient")
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="fake server latency, seconds")
+    args = parser.parse_args()
+
+    with FakeMoltinServer(latency=args.latency) as server:
+        token = server.access_token({}, b"")[1]["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        url = f"{server.url}/v2/products/"
+
+        def bare_call():
+            response = requests.get(url, headers=headers)
+            response.raise_for_status()
+            return response.json()["data"]
+
+        server.reset_stats()
+        report("requests.get per call", measure(bare_call, args.calls), len(server.connections_seen))
+
+        client = MoltinClient(base_url=server.url)
+        server.reset_stats()
+        report("MoltinClient (pooled)", measure(lambda: client.get_products(token), args.calls), len(server.connections_seen))
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
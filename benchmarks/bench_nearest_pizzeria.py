@@ -0,0 +1,92 @@
+import argparse
+import random
+import time
+
+from geopy import distance
+
+from delivery import DeliveryZones, get_tier
+from menu_loader import iter_addresses
+from utilits import PizzeriaIndex
+
+
+def legacy_nearest_pizzeria(customer_position, pizzerias):
+    distance_to_pizzerias = {}
+    for pizzeria, pizzeria_position in pizzerias.items():
+        distance_to_pizzerias[pizzeria] = round(
+            distance.distance(customer_position, pizzeria_position).km, 3
+        )
+    nearest_pizzeria = min(distance_to_pizzerias, key=distance_to_pizzerias.get)
+    return nearest_pizzeria, distance_to_pizzerias[nearest_pizzeria]
+
+
+def random_position(rng, center=(55.75, 37.62), spread=0.6):
+    return center[0] + rng.uniform(-spread, spread), center[1] + rng.uniform(-spread, spread)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nearest pizzeria: geodesic loop vs spatial index")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--grid-depths", type=int, nargs="+", default=[0, 3],
+                        help="refine_depth values of the delivery grid to compare")
+    parser.add_argument("--grid-queries", type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'locations':>9}  {'loop, ms/query':>15}  {'index, ms/query':>16}  {'build, ms':>10}  speedup")
+    for size in args.sizes:
+        pizzerias = {f"pizzeria {number}": random_position(rng) for number in range(size)}
+        customers = [random_position(rng, spread=0.7) for _ in range(args.queries)]
+
+        started_at = time.perf_counter()
+        index = PizzeriaIndex(pizzerias)
+        build_ms = (time.perf_counter() - started_at) * 1000
+
+        started_at = time.perf_counter()
+        expected = [legacy_nearest_pizzeria(customer, pizzerias) for customer in customers]
+        loop_ms = (time.perf_counter() - started_at) * 1000 / args.queries
+
+        started_at = time.perf_counter()
+        found = [index.nearest(customer) for customer in customers]
+        index_ms = (time.perf_counter() - started_at) * 1000 / args.queries
+
+        assert [distance_km for _, distance_km in found] == [distance_km for _, distance_km in expected]
+        print(f"{size:>9}  {loop_ms:>15.3f}  {index_ms:>16.3f}  {build_ms:>10.1f}  {loop_ms / index_ms:6.1f}x")
+
+    bench_delivery_grid(rng, args.grid_depths, args.grid_queries)
+
+
+def bench_delivery_grid(rng, depths, queries):
+    # Real pizzerias and customers spread over the box they cover, so the
+    # hit rate is the share of in-city quotes answered by the grid.
+    pizzerias = {pizzeria.address: (pizzeria.lat, pizzeria.lon) for pizzeria in iter_addresses()}
+    lats = [lat for lat, _ in pizzerias.values()]
+    lons = [lon for _, lon in pizzerias.values()]
+    customers = [
+        (rng.uniform(min(lats), max(lats)), rng.uniform(min(lons), max(lons)))
+        for _ in range(queries)
+    ]
+    index = PizzeriaIndex(pizzerias)
+    expected = [index.nearest(customer) for customer in customers]
+
+    print(f"\nDelivery grid, {len(pizzerias)} pizzerias from addresses.json, {queries} in-city quotes")
+    print(f"{'depth':>5}  {'build, s':>8}  {'cells':>6}  {'hits':>6}  {'quote, us':>9}")
+    for depth in depths:
+        started_at = time.perf_counter()
+        zones = DeliveryZones(index, refine_depth=depth)
+        build_s = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        quotes = [zones.quote(customer) for customer in customers]
+        quote_us = (time.perf_counter() - started_at) * 1e6 / queries
+
+        hits = sum(zones.lookup(customer) is not None for customer in customers)
+        assert [(quote.address, quote.tier) for quote in quotes] == [
+            (address, get_tier(distance_km)) for address, distance_km in expected
+        ]
+        print(f"{depth:>5}  {build_s:>8.2f}  {len(zones.cells):>6}  {hits / queries:>6.1%}  {quote_us:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import threading
+import time
+from collections import defaultdict
+
+from telegram import Update, User
+from telegram.ext import TypeHandler
+
+from benchmarks.fake_servers import FakeMoltinServer
+from shop import MoltinClient
+from tg_workers import create_dispatcher
+
+
+def make_update(bot, update_id, chat_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "text": str(update_id),
+        },
+    }, bot)
+
+
+def run_load(moltin, workers, updates, chats, calls_per_update):
+    client = MoltinClient(base_url=moltin.url, pool_size=workers)
+    product_id = next(iter(moltin.products))
+    handled = defaultdict(list)
+    done = threading.Semaphore(0)
+
+    def handle(update, context):
+        # Stands in for a handler blocked on Moltin: a few sequential reads.
+        for _ in range(calls_per_update):
+            client.get_product("token", product_id)
+        handled[update.effective_chat.id].append(update.update_id)
+        done.release()
+
+    dispatcher = create_dispatcher("123456:benchmark", workers)
+    # The dispatcher names its threads after the bot; skip the getMe call.
+    dispatcher.bot._bot = User(id=123456, first_name="benchmark", is_bot=True)
+    dispatcher.add_handler(TypeHandler(Update, handle))
+    dispatcher_thread = threading.Thread(target=dispatcher.start, daemon=True)
+    dispatcher_thread.start()
+
+    sent = [make_update(dispatcher.bot, number, number % chats) for number in range(updates)]
+    started_at = time.perf_counter()
+    for update in sent:
+        dispatcher.update_queue.put(update)
+    for _ in sent:
+        done.acquire()
+    elapsed = time.perf_counter() - started_at
+
+    dispatcher.stop()
+    dispatcher_thread.join()
+    client.close()
+
+    for chat_id, update_ids in handled.items():
+        assert update_ids == sorted(update_ids), f"chat {chat_id} handled out of order"
+    return updates / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram updates per second by worker count")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--updates", type=int, default=400)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--calls-per-update", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.01, help="Fake Moltin latency, seconds")
+    args = parser.parse_args()
+
+    with FakeMoltinServer(latency=args.latency) as moltin:
+        print(f"{args.updates} updates from {args.chats} chats, "
+              f"{args.calls_per_update} Moltin calls of {args.latency * 1000:.0f} ms each")
+        print(f"{'workers':>7}  {'updates/s':>10}  speedup")
+        baseline = None
+        for workers in args.workers:
+            throughput = run_load(moltin, workers, args.updates, args.chats, args.calls_per_update)
+            baseline = baseline or throughput
+            print(f"{workers:>7}  {throughput:>10.1f}  {throughput / baseline:6.1f}x")
+    print("Per-chat order was preserved in every run")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_one_request(self):
+        self.server.connections_seen.add(self.client_address)
+        super().handle_one_request()
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_body(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def dispatch(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        body = self.read_body()
+        self.server.calls[f"{self.command} {self.server.route_name(path)}"] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, response, content_type = self.server.route(self.command, path, query, body)
+        self.send_body(status, response, content_type)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = dispatch
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    routes = ()
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeHandler)
+        self.latency = latency
+        self.calls = Counter()
+        self.connections_seen = set()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def route_name(self, path):
+        for _, pattern, _ in self.routes:
+            if re.fullmatch(pattern, path):
+                return pattern
+        return path
+
+    def route(self, method, path, query, body):
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                handler = getattr(self, handler_name)
+                return handler(query, body, *match.groups())
+        return 404, {"errors": [{"status": 404, "title": "Not Found"}]}, "application/json"
+
+    def reset_stats(self):
+        self.calls.clear()
+        self.connections_seen.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def ok(data, status=200):
+    return status, data, "application/json"
+
+
+def load_json(body):
+    return json.loads(body) if body else {}
+
+
+class FakeMoltinServer(FakeServer):
+    routes = (
+        ("POST", r"/oauth/access_token", "access_token"),
+        ("GET", r"/v2/products/?", "list_products"),
+        ("POST", r"/v2/products", "create_product"),
+        ("GET", r"/v2/products/([^/]+)", "get_product"),
+        ("POST", r"/v2/products/([^/]+)/relationships/main-image", "link_image"),
+        ("GET", r"/v2/categories", "list_categories"),
+        ("GET", r"/v2/files", "list_files"),
+        ("POST", r"/v2/files", "create_file"),
+        ("GET", r"/v2/files/([^/]+)", "get_file"),
+        ("HEAD", r"/images/([^/]+)\.jpg", "get_image"),
+        ("GET", r"/images/([^/]+)\.jpg", "get_image"),
+        ("GET", r"/v2/carts/([^/]+)", "get_cart"),
+        ("GET", r"/v2/carts/([^/]+)/items", "get_cart_items"),
+        ("POST", r"/v2/carts/([^/]+)/items", "add_cart_item"),
+        ("DELETE", r"/v2/carts/([^/]+)/items/([^/]+)", "delete_cart_item"),
+        ("POST", r"/v2/customers", "create_customer"),
+        ("GET", r"/v2/flows/([^/]+)/entries", "list_entries"),
+        ("POST", r"/v2/flows/([^/]+)/entries", "create_entry"),
+        ("PUT", r"/v2/flows/([^/]+)/entries/([^/]+)", "update_entry"),
+        ("DELETE", r"/v2/flows/([^/]+)/entries/([^/]+)", "delete_entry"),
+        ("POST", r"/v2/flows", "create_flow"),
+        ("GET", r"/v2/flows/([^/]+)", "get_flow"),
+        ("GET", r"/v2/flows/([^/]+)/fields", "list_fields"),
+        ("POST", r"/v2/fields", "create_field"),
+    )
+
+    def __init__(self, products=24, categories=3, pizzerias=None, image_size=300_000, **kwargs):
+        super().__init__(**kwargs)
+        self.image_bytes = b"\xff" * image_size
+        self.lock = threading.Lock()
+        self.categories = [
+            {"id": str(uuid4()), "slug": slug, "name": slug.title()}
+            for slug in ["basic", "spicy", "hearty", "veggie", "special"][:categories]
+        ]
+        self.files = {}
+        self.products = {}
+        for number in range(products):
+            image_id = str(uuid4())
+            self.files[image_id] = self.file_record(image_id)
+            category = self.categories[number % len(self.categories)]
+            product = self.product_record(
+                name=f"Пицца {number}",
+                sku=f"sk{number}",
+                description=f"Описание пиццы {number}",
+                amount=(300 + number) * 100,
+            )
+            product["relationships"] = {
+                "main_image": {"data": {"type": "main_image", "id": image_id}},
+                "categories": {"data": [{"type": "category", "id": category["id"]}]},
+            }
+            self.products[product["id"]] = product
+        self.carts = {}
+        self.flows = {"pizzeria": {}, "customer": {}}
+        for alias, address, lat, lon in pizzerias or []:
+            entry_id = str(uuid4())
+            self.flows["pizzeria"][entry_id] = {
+                "id": entry_id,
+                "type": "entry",
+                "alias": alias,
+                "address": address,
+                "latitude": lat,
+                "longitude": lon,
+            }
+        self.fields = {}
+
+    def file_record(self, image_id, href=None):
+        return {
+            "type": "file",
+            "id": image_id,
+            "link": {"href": href or f"{self.url}/images/{image_id}.jpg"},
+        }
+
+    def product_record(self, name, sku, description, amount):
+        return {
+            "type": "product",
+            "id": str(uuid4()),
+            "name": name,
+            "sku": sku,
+            "slug": sku,
+            "description": description,
+            "price": [{"amount": amount, "currency": "RUB", "includes_tax": True}],
+            "meta": {
+                "display_price": {
+                    "with_tax": {
+                        "amount": amount,
+                        "currency": "RUB",
+                        "formatted": f"{amount / 100:.2f} ₽",
+                    },
+                },
+            },
+            "relationships": {},
+        }
+
+    def access_token(self, query, body):
+        now = int(time.time())
+        return ok({
+            "access_token": uuid4().hex,
+            "token_type": "Bearer",
+            "expires_in": 3600,
+            "expires": now + 3600,
+        })
+
+    def list_products(self, query, body):
+        products = list(self.products.values())
+        category_filter = re.fullmatch(r"eq\(category\.id,(.+)\)", query.get("filter", ""))
+        if category_filter:
+            category_id = category_filter.group(1)
+            products = [
+                product for product in products
+                if {"type": "category", "id": category_id}
+                in product["relationships"].get("categories", {}).get("data", [])
+            ]
+        offset = int(query.get("page[offset]", 0))
+        limit = int(query.get("page[limit]", 100))
+        page = products[offset:offset + limit]
+        response = {
+            "data": page,
+            "meta": {"results": {"total": len(products)}},
+        }
+        if query.get("include") == "main_image":
+            image_ids = [
+                product["relationships"]["main_image"]["data"]["id"]
+                for product in page
+                if "main_image" in product["relationships"]
+            ]
+            response["included"] = {
+                "main_images": [self.files[image_id] for image_id in image_ids],
+            }
+        return ok(response)
+
+    def create_product(self, query, body):
+        data = load_json(body)["data"]
+        if any(product["sku"] == data["sku"] for product in self.products.values()):
+            return 409, {"errors": [{"status": 409, "title": "Duplicate sku"}]}, "application/json"
+        product = self.product_record(
+            name=data["name"],
+            sku=data["sku"],
+            description=data["description"],
+            amount=data["price"][0]["amount"],
+        )
+        with self.lock:
+            self.products[product["id"]] = product
+        return ok({"data": product}, status=201)
+
+    def get_product(self, query, body, product_id):
+        if product_id not in self.products:
+            return 404, {"errors": [{"status": 404}]}, "application/json"
+        return ok({"data": self.products[product_id]})
+
+    def link_image(self, query, body, product_id):
+        image_id = load_json(body)["data"]["id"]
+        self.products[product_id]["relationships"]["main_image"] = {
+            "data": {"type": "main_image", "id": image_id},
+        }
+        return ok({"data": {"type": "main_image", "id": image_id}})
+
+    def list_categories(self, query, body):
+        return ok({"data": [dict(category, type="category") for category in self.categories]})
+
+    def list_files(self, query, body):
+        files = list(self.files.values())
+        id_filter = re.fullmatch(r"in\(id,(.+)\)", query.get("filter", ""))
+        if id_filter:
+            ids = set(id_filter.group(1).split(","))
+            files = [file for file in files if file["id"] in ids]
+        return ok({"data": files})
+
+    def create_file(self, query, body):
+        image_id = str(uuid4())
+        match = re.search(rb'name="file_location"\r\n\r\n([^\r]+)', body)
+        href = match.group(1).decode() if match else None
+        with self.lock:
+            self.files[image_id] = self.file_record(image_id, href)
+        return ok({"data": self.files[image_id]}, status=201)
+
+    def get_file(self, query, body, image_id):
+        if image_id not in self.files:
+            return 404, {"errors": [{"status": 404}]}, "application/json"
+        return ok({"data": self.files[image_id]})
+
+    def get_image(self, query, body, image_id):
+        return 200, self.image_bytes, "image/jpeg"
+
+    def cart_meta(self, items):
+        amount = sum(item["value"]["amount"] for item in items)
+        return {
+            "display_price": {
+                "with_tax": {
+                    "amount": amount,
+                    "currency": "RUB",
+                    "formatted": f"{amount / 100:.2f} ₽",
+                },
+            },
+        }
+
+    def cart_items_response(self, cart_id):
+        items = list(self.carts.get(cart_id, {}).values())
+        return {"data": items, "meta": self.cart_meta(items)}
+
+    def get_cart(self, query, body, cart_id):
+        items = list(self.carts.get(cart_id, {}).values())
+        return ok({"data": {"id": cart_id, "type": "cart", "meta": self.cart_meta(items)}})
+
+    def get_cart_items(self, query, body, cart_id):
+        return ok(self.cart_items_response(cart_id))
+
+    def add_cart_item(self, query, body, cart_id):
+        data = load_json(body)["data"]
+        product = self.products[data["id"]]
+        unit_amount = product["price"][0]["amount"]
+        with self.lock:
+            cart = self.carts.setdefault(cart_id, {})
+            item = next(
+                (item for item in cart.values() if item["product_id"] == product["id"]),
+                None,
+            )
+            if item is None:
+                item = {
+                    "id": str(uuid4()),
+                    "type": "cart_item",
+                    "product_id": product["id"],
+                    "name": product["name"],
+                    "description": product["description"],
+                    "sku": product["sku"],
+                    "quantity": 0,
+                    "unit_price": {"amount": unit_amount, "currency": "RUB"},
+                }
+                cart[item["id"]] = item
+            item["quantity"] += data.get("quantity", 1)
+            total = unit_amount * item["quantity"]
+            item["value"] = {"amount": total, "currency": "RUB"}
+            item["meta"] = {
+                "display_price": {
+                    "with_tax": {
+                        "unit": {"amount": unit_amount, "formatted": f"{unit_amount / 100:.2f}"},
+                        "value": {"amount": total, "formatted": f"{total / 100:.2f}"},
+                    },
+                },
+            }
+        return ok(self.cart_items_response(cart_id), status=201)
+
+    def delete_cart_item(self, query, body, cart_id, item_id):
+        with self.lock:
+            self.carts.get(cart_id, {}).pop(item_id, None)
+        return ok(self.cart_items_response(cart_id))
+
+    def create_customer(self, query, body):
+        data = load_json(body)["data"]
+        return ok({"data": dict(data, id=str(uuid4()))}, status=201)
+
+    def list_entries(self, query, body, flow_slug):
+        entries = list(self.flows.get(flow_slug, {}).values())
+        offset = int(query.get("page[offset]", 0))
+        limit = int(query.get("page[limit]", 25))
+        return ok({
+            "data": entries[offset:offset + limit],
+            "meta": {"results": {"total": len(entries)}},
+        })
+
+    def create_entry(self, query, body, flow_slug):
+        entry = dict(load_json(body)["data"], id=str(uuid4()))
+        with self.lock:
+            self.flows.setdefault(flow_slug, {})[entry["id"]] = entry
+        return ok({"data": entry}, status=201)
+
+    def update_entry(self, query, body, flow_slug, entry_id):
+        with self.lock:
+            entry = self.flows[flow_slug][entry_id]
+            entry.update(load_json(body)["data"])
+        return ok({"data": entry})
+
+    def delete_entry(self, query, body, flow_slug, entry_id):
+        with self.lock:
+            self.flows.get(flow_slug, {}).pop(entry_id, None)
+        return 204, b"", "application/json"
+
+    def create_flow(self, query, body):
+        data = load_json(body)["data"]
+        self.flows.setdefault(data["slug"], {})
+        return ok({"data": dict(data, id=data["slug"])}, status=201)
+
+    def get_flow(self, query, body, flow_slug):
+        return ok({"data": {"id": flow_slug, "type": "flow", "slug": flow_slug}})
+
+    def list_fields(self, query, body, flow_slug):
+        return ok({"data": [
+            field for field in self.fields.values()
+            if field["relationships"]["flow"]["data"]["id"] in (flow_slug, )
+        ]})
+
+    def create_field(self, query, body):
+        field = dict(load_json(body)["data"], id=str(uuid4()))
+        self.fields[field["id"]] = field
+        return ok({"data": field}, status=201)
+
+
+class FakeYandexGeocoderServer(FakeServer):
+    routes = (
+        ("GET", r"/1\.x/?", "geocode"),
+    )
+
+    def __init__(self, addresses=None, **kwargs):
+        super().__init__(**kwargs)
+        self.addresses = addresses or {}
+
+    def geocode(self, query, body):
+        position = self.addresses.get(query.get("geocode"))
+        feature_members = []
+        if position:
+            lat, lon = position
+            feature_members.append({"GeoObject": {"Point": {"pos": f"{lon} {lat}"}}})
+        return ok({"response": {"GeoObjectCollection": {"featureMember": feature_members}}})
+
+
+class FakeGraphServer(FakeServer):
+    routes = (
+        ("POST", r"/me/messages", "send_message"),
+        ("POST", r"/?", "batch"),
+    )
+
+    def __init__(self, transient_failures=0, **kwargs):
+        super().__init__(**kwargs)
+        self.transient_failures = transient_failures
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def deliver(self, recipient, message):
+        with self.lock:
+            if self.transient_failures:
+                self.transient_failures -= 1
+                return 500, {"error": {"code": 2, "is_transient": True}}
+            message_id = f"m_{uuid4().hex}"
+            self.messages.append((json.loads(recipient)["id"], json.loads(message)))
+        return 200, {"recipient_id": json.loads(recipient)["id"], "message_id": message_id}
+
+    def send_message(self, query, body):
+        data = load_json(body)
+        status, response = self.deliver(json.dumps(data["recipient"]), json.dumps(data["message"]))
+        return ok(response, status=status)
+
+    def batch(self, query, body):
+        form = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+        results = []
+        for operation in json.loads(form["batch"]):
+            if results and results[-1]["code"] != 200:
+                results.append(None)
+                continue
+            fields = {key: values[-1] for key, values in parse_qs(operation["body"]).items()}
+            status, response = self.deliver(fields["recipient"], fields["message"])
+            results.append({"code": status, "body": json.dumps(response)})
+        return ok(results)
+
+
+class FakeTelegramServer(FakeServer):
+    # Serves the Bot API under /bot<token>/<method>; point a bot at it with
+    # base_url=f"{server.url}/bot".
+    routes = (
+        ("POST", r"/bot[^/]+/(\w+)", "call_method"),
+        ("GET", r"/bot[^/]+/(\w+)", "call_method"),
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.Lock()
+        self.message_ids = 0
+        self.file_ids = 0
+        self.requests = []
+
+    def route_name(self, path):
+        match = re.fullmatch(r"/bot[^/]+/(\w+)", path)
+        return match.group(1) if match else path
+
+    def next_message(self, data, **fields):
+        with self.lock:
+            self.message_ids += 1
+            message_id = self.message_ids
+        return dict(
+            fields,
+            message_id=message_id,
+            date=int(time.time()),
+            chat={"id": int(data.get("chat_id", 0)), "type": "private"},
+        )
+
+    def next_photo(self):
+        with self.lock:
+            self.file_ids += 1
+            file_id = f"photo{self.file_ids}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480}]
+
+    def call_method(self, query, body, method):
+        try:
+            data = dict(query, **load_json(body))
+        except ValueError:
+            # Multipart uploads; the fields are not needed for the response.
+            data = dict(query)
+        with self.lock:
+            self.requests.append((method, data))
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "benchmark", "username": "benchmark_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self.next_message(data, text=data.get("text", ""))
+        elif method == "sendPhoto":
+            result = self.next_message(data, photo=self.next_photo())
+        elif method == "sendLocation":
+            result = self.next_message(
+                data,
+                location={"latitude": data.get("latitude"), "longitude": data.get("longitude")},
+            )
+        elif method == "sendInvoice":
+            result = self.next_message(data, invoice={
+                "title": data.get("title", ""),
+                "description": data.get("description", ""),
+                "start_parameter": "",
+                "currency": data.get("currency", ""),
+                "total_amount": 0,
+            })
+        else:
+            result = True
+        return ok({"ok": True, "result": result})
@@ -0,0 +1,69 @@
+import json
+import logging
+import threading
+import time
+
+from async_shop import get_cart_with_total, run
+from shop import add_to_cart, delete_cart_items
+
+
+logger = logging.getLogger(__name__)
+
+_cart_mirror = None
+_cart_mirror_lock = threading.Lock()
+
+
+class CartMirror:
+    # Our own cart mutations store the items response Moltin returns for
+    # them, so redrawing a cart is one HGETALL. Moltin stays the source of
+    # truth: a mirror older than reconcile_interval is reloaded from it, and
+    # an unused one expires after ttl.
+    def __init__(self, database, ttl=24 * 3600, reconcile_interval=300):
+        self.database = database
+        self.ttl = ttl
+        self.reconcile_interval = reconcile_interval
+
+    def key(self, cart_id):
+        return f"cart:{cart_id}"
+
+    def get(self, access_token, cart_id):
+        stored_cart = self.database.hgetall(self.key(cart_id))
+        if stored_cart and time.time() - float(stored_cart["synced_at"]) < self.reconcile_interval:
+            return json.loads(stored_cart["items"]), {"meta": json.loads(stored_cart["meta"])}
+
+        cart_items, cart = run(get_cart_with_total(access_token, cart_id))
+        self._store(cart_id, cart_items, cart["meta"])
+        if stored_cart:
+            logger.debug(f"Reconciled cart {cart_id} with Moltin")
+
+        return cart_items, cart
+
+    def add(self, access_token, cart_id, product_id, quantity=1):
+        cart_items = add_to_cart(access_token, product_id, cart_id, quantity)
+        self._store(cart_id, cart_items["data"], cart_items["meta"])
+
+    def remove(self, access_token, cart_id, item_id):
+        cart_items = delete_cart_items(access_token, cart_id, item_id)
+        self._store(cart_id, cart_items["data"], cart_items["meta"])
+
+    def invalidate(self, cart_id):
+        self.database.delete(self.key(cart_id))
+
+    def _store(self, cart_id, items, meta):
+        pipeline = self.database.pipeline()
+        pipeline.hmset(self.key(cart_id), {
+            "items": json.dumps(items),
+            "meta": json.dumps(meta),
+            "synced_at": time.time(),
+        })
+        pipeline.expire(self.key(cart_id), self.ttl)
+        pipeline.execute()
+
+
+def get_cart_mirror(database):
+    global _cart_mirror
+    if _cart_mirror is None:
+        with _cart_mirror_lock:
+            if _cart_mirror is None:
+                _cart_mirror = CartMirror(database)
+    return _cart_mirror
@@ -0,0 +1,141 @@
+import json
+import logging
+import threading
+import time
+from uuid import uuid4
+
+from async_shop import get_catalog_data, run
+
+
+logger = logging.getLogger(__name__)
+
+CATALOG_KEY = "catalog"
+CATALOG_VERSION_KEY = "catalog_version"
+CATALOG_REBUILD_LOCK_KEY = "catalog_rebuild_lock"
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+class CatalogSnapshot:
+    def __init__(self, version, products, categories, image_urls):
+        self.version = version
+        self.products = products
+        self.categories = categories
+        self.image_urls = image_urls
+        self.products_by_id = {product["id"]: product for product in products}
+
+        category_slugs = {category["id"]: slug for slug, category in categories.items()}
+        self.category_products = {slug: [] for slug in categories}
+        for product in products:
+            product_categories = product.get("relationships", {}).get("categories", {})
+            for category in product_categories.get("data", []):
+                slug = category_slugs.get(category["id"])
+                if slug:
+                    self.category_products[slug].append(product)
+
+    def get_product(self, product_id):
+        return self.products_by_id[product_id]
+
+    def get_image_url(self, product_id):
+        return self.image_urls.get(product_id)
+
+    def get_image_id(self, product_id):
+        main_image = self.products_by_id[product_id].get("relationships", {}).get("main_image")
+        return main_image["data"]["id"] if main_image and main_image.get("data") else None
+
+    def get_category_products(self, slug):
+        return self.category_products.get(slug, [])
+
+    def dumps(self):
+        return json.dumps({
+            "version": self.version,
+            "products": self.products,
+            "categories": self.categories,
+            "image_urls": self.image_urls,
+        })
+
+    @classmethod
+    def loads(cls, serialized_snapshot):
+        return cls(**json.loads(serialized_snapshot))
+
+
+def fetch_catalog_snapshot(access_token):
+    products, categories, image_urls = run(get_catalog_data(access_token))
+
+    return CatalogSnapshot(uuid4().hex, products, categories, image_urls)
+
+
+class Catalog:
+    def __init__(self, database, ttl=3600, check_interval=30):
+        self.database = database
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self._snapshot = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, access_token):
+        if self._snapshot and time.monotonic() - self._checked_at < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if self._snapshot and time.monotonic() - self._checked_at < self.check_interval:
+                return self._snapshot
+
+            version = self.database.get(CATALOG_VERSION_KEY)
+            if version is None:
+                self._snapshot = self.rebuild(access_token)
+            elif self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = self._load() or self.rebuild(access_token)
+            self._checked_at = time.monotonic()
+
+            return self._snapshot
+
+    def rebuild(self, access_token):
+        lock = self.database.lock(CATALOG_REBUILD_LOCK_KEY, timeout=60, blocking_timeout=60)
+        acquired = lock.acquire(blocking=True)
+        try:
+            # Another worker may have published a snapshot while we waited.
+            if self.database.get(CATALOG_VERSION_KEY) is not None:
+                snapshot = self._load()
+                if snapshot:
+                    return snapshot
+
+            started_at = time.monotonic()
+            snapshot = fetch_catalog_snapshot(access_token)
+            self.publish(snapshot)
+            logger.info(
+                f"Catalog {snapshot.version} rebuilt with {len(snapshot.products)} products "
+                f"in {time.monotonic() - started_at:.2f}s"
+            )
+            return snapshot
+        finally:
+            if acquired:
+                lock.release()
+
+    def publish(self, snapshot):
+        pipeline = self.database.pipeline()
+        pipeline.set(CATALOG_KEY, snapshot.dumps(), ex=self.ttl)
+        pipeline.set(CATALOG_VERSION_KEY, snapshot.version, ex=self.ttl)
+        pipeline.execute()
+
+    def invalidate(self):
+        self.database.delete(CATALOG_VERSION_KEY)
+        self._checked_at = 0
+
+    def _load(self):
+        serialized_snapshot = self.database.get(CATALOG_KEY)
+        if serialized_snapshot is None:
+            return None
+        return CatalogSnapshot.loads(serialized_snapshot)
+
+
+def get_catalog(database):
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = Catalog(database)
+    return _catalog
@@ -0,0 +1,274 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from textwrap import dedent
+
+from geopy import distance
+
+from utilits import EARTH_RADIUS_KM, SPHERE_ERROR, chord_to_km, to_unit_vector
+
+
+DELIVERY_TIERS = (
+    {
+        "max_distance": 0.5,
+        "price": 0,
+        "deliverable": True,
+        "message": dedent('''
+            Может, заберете пиццу из нашей пиццерии неподалеку?
+
+            Она всего в {distance_m:.0f} метрах от Вас!
+            Вот её адрес: {address}.
+
+            А можем и бесплатно оставить, нам не сложно))
+            '''),
+    },
+    {
+        "max_distance": 5,
+        "price": 100,
+        "deliverable": True,
+        "message": dedent('''
+            Доставим Вашу пиццу за {price} рублей.
+
+            Или можете забрать ее по адресу: {address}
+            '''),
+    },
+    {
+        "max_distance": 20,
+        "price": 300,
+        "deliverable": True,
+        "message": dedent('''
+            Доставим Вашу пиццу за {price} рублей.
+
+            Или можете забрать ее по адресу: {address}
+            '''),
+    },
+)
+
+REFUSED_TIER = {
+    "max_distance": math.inf,
+    "price": None,
+    "deliverable": False,
+    "message": dedent('''
+        Простите, но так далеко мы пиццу не доставим.
+
+        Ближайшая пиццерия аж в {distance:.2f} километрах от Вас.
+
+        Заезжайте к нам в гости: {address}
+        '''),
+}
+
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+logger = logging.getLogger(__name__)
+
+_delivery_zones = None
+_delivery_zones_lock = threading.Lock()
+
+
+def get_tier(distance_km, tiers=DELIVERY_TIERS):
+    for tier in tiers:
+        if distance_km <= tier["max_distance"]:
+            return tier
+    return REFUSED_TIER
+
+
+class DeliveryQuote:
+    def __init__(self, position, address, pizzeria_position, tier, distance_km=None):
+        self.position = position
+        self.address = address
+        self.pizzeria_position = pizzeria_position
+        self.tier = tier
+        self._distance = distance_km
+
+    @property
+    def price(self):
+        return self.tier["price"]
+
+    @property
+    def deliverable(self):
+        return self.tier["deliverable"]
+
+    @property
+    def distance(self):
+        if self._distance is None:
+            self._distance = round(distance.distance(self.position, self.pizzeria_position).km, 3)
+        return self._distance
+
+    @property
+    def distance_m(self):
+        return self.distance * 1000
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def get_message(self):
+        return self.tier["message"].format_map(self)
+
+
+class DeliveryZones:
+    def __init__(self, pizzeria_index, tiers=DELIVERY_TIERS, cell_size_km=0.5, refine_depth=3,
+                 build=True):
+        self.index = pizzeria_index
+        self.tiers = tiers
+        self.positions = dict(zip(pizzeria_index.names, pizzeria_index.positions))
+
+        self.cell_size_km = cell_size_km
+        self.refine_depth = refine_depth
+        self.lat_step = cell_size_km / KM_PER_DEGREE
+        reference_lat = (
+            sum(lat for lat, _ in pizzeria_index.positions) / len(pizzeria_index)
+            if len(pizzeria_index) else 0
+        )
+        self.lon_step = self.lat_step / max(math.cos(math.radians(reference_lat)), 0.01)
+        self.cells = self._build() if build else {}
+
+    def build_in_background(self):
+        # The grid takes seconds for a few hundred pizzerias; until it is
+        # ready every quote takes the exact search.
+        def build():
+            started_at = time.monotonic()
+            try:
+                self.cells = self._build()
+            except Exception as err:
+                logger.warning(f"Delivery grid was not built: {err!r}")
+                return
+            logger.info(
+                f"Built delivery grid of {len(self.cells)} cells for {len(self.index)} "
+                f"pizzerias in {time.monotonic() - started_at:.1f}s"
+            )
+
+        threading.Thread(target=build, name="delivery-zones", daemon=True).start()
+
+    def _cell(self, position):
+        lat, lon = map(float, position)
+        return math.floor(lat / self.lat_step), math.floor(lon / self.lon_step)
+
+    def lookup(self, position):
+        # Returns (address, tier) when the grid answers for the position,
+        # otherwise None.
+        lat, lon = map(float, position)
+        lat_offset, lon_offset = lat / self.lat_step, lon / self.lon_step
+        lat_cell, lon_cell = math.floor(lat_offset), math.floor(lon_offset)
+        node = self.cells.get((lat_cell, lon_cell))
+        lat_offset -= lat_cell
+        lon_offset -= lon_cell
+        while isinstance(node, list):
+            lat_offset *= 2
+            lon_offset *= 2
+            lat_half, lon_half = int(lat_offset >= 1), int(lon_offset >= 1)
+            node = node[2 * lat_half + lon_half]
+            lat_offset -= lat_half
+            lon_offset -= lon_half
+        return node
+
+    def _build(self):
+        # A cell is answered from the grid only when one pizzeria is nearest
+        # and one tier applies everywhere inside it. Cells on a zone or tier
+        # boundary are split into quarters up to refine_depth times; what is
+        # still ambiguous is left to the exact search.
+        if not len(self.index):
+            return {}
+
+        service_radius = max(tier["max_distance"] for tier in self.tiers)
+        lat_cells = math.ceil(service_radius / self.cell_size_km) + 1
+
+        candidate_cells = set()
+        for position in self.index.positions:
+            lat_cell, lon_cell = self._cell(position)
+            lon_cell_km = self.lon_step * KM_PER_DEGREE * math.cos(math.radians(position[0]))
+            lon_cells = math.ceil(service_radius / lon_cell_km) + 1
+            for lat_offset in range(-lat_cells, lat_cells + 1):
+                for lon_offset in range(-lon_cells, lon_cells + 1):
+                    candidate_cells.add((lat_cell + lat_offset, lon_cell + lon_offset))
+
+        cells = {}
+        for lat_cell, lon_cell in candidate_cells:
+            node = self._build_node(
+                lat_cell * self.lat_step, lon_cell * self.lon_step, self.lat_step, self.lon_step, 0
+            )
+            if node is not None:
+                cells[(lat_cell, lon_cell)] = node
+
+        return cells
+
+    def _build_node(self, lat, lon, lat_size, lon_size, depth, candidates=None):
+        center = to_unit_vector((lat + lat_size / 2, lon + lon_size / 2))
+        half_diagonal_chord = math.dist(center, to_unit_vector((lat, lon))) * 1.01
+        half_diagonal = chord_to_km(half_diagonal_chord)
+
+        neighbours = min(2, len(self.index))
+        if candidates is None:
+            nearest = self.index._k_nearest_chords(center, neighbours)
+        else:
+            nearest = heapq.nsmallest(neighbours, (
+                (math.dist(center, self.index.points[index]), index) for index in candidates
+            ))
+        nearest_km = chord_to_km(nearest[0][0])
+        farthest_in_cell = (nearest_km + half_diagonal) * SPHERE_ERROR
+        closest_in_cell = max(nearest_km - half_diagonal, 0) / SPHERE_ERROR
+
+        tier = get_tier(closest_in_cell, self.tiers)
+        if tier is REFUSED_TIER:
+            return None
+
+        ambiguous = tier is not get_tier(farthest_in_cell, self.tiers)
+        if len(nearest) > 1:
+            runner_up_km = chord_to_km(nearest[1][0])
+            ambiguous = ambiguous or farthest_in_cell >= (runner_up_km - half_diagonal) / SPHERE_ERROR
+
+        if not ambiguous:
+            return self.index.names[nearest[0][1]], tier
+        # Quarters smaller than the sphere error around them cannot settle
+        # anything the exact search would not.
+        if depth == self.refine_depth or half_diagonal < nearest_km * (SPHERE_ERROR ** 2 - 1):
+            return None
+
+        # The two nearest pizzerias of any point in the cell are within this
+        # chord of its center, so the quarters only have to look at these.
+        reach = nearest[-1][0] + 2 * half_diagonal_chord
+        if candidates is None:
+            candidates = self.index._within_chord(center, reach)
+        else:
+            candidates = [
+                index for index in candidates
+                if math.dist(center, self.index.points[index]) <= reach
+            ]
+
+        lat_size, lon_size = lat_size / 2, lon_size / 2
+        children = [
+            self._build_node(lat + lat_half * lat_size, lon + lon_half * lon_size,
+                             lat_size, lon_size, depth + 1, candidates)
+            for lat_half in (0, 1)
+            for lon_half in (0, 1)
+        ]
+        if all(child is None for child in children):
+            return None
+        return children
+
+    def quote(self, position):
+        position = tuple(map(float, position))
+        cell = self.lookup(position)
+        if cell is not None:
+            address, tier = cell
+            return DeliveryQuote(position, address, self.positions[address], tier)
+
+        address, distance_km = self.index.nearest(position)
+        return DeliveryQuote(
+            position,
+            address,
+            self.positions[address],
+            get_tier(distance_km, self.tiers),
+            distance_km,
+        )
+
+
+def get_delivery_zones(pizzeria_index):
+    global _delivery_zones
+    if _delivery_zones is None or _delivery_zones.index is not pizzeria_index:
+        with _delivery_zones_lock:
+            if _delivery_zones is None or _delivery_zones.index is not pizzeria_index:
+                _delivery_zones = DeliveryZones(pizzeria_index, build=False)
+                _delivery_zones.build_in_background()
+    return _delivery_zones
@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+import time
+import zlib
+from uuid import uuid4
+
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "fb_events:{shard}"
+PROCESSING_KEY = "fb_events:{shard}:processing"
+METRICS_KEY = "fb_queue_metrics"
+STARTED_KEY = "fb_events:started:{event_id}"
+STARTED_TTL = 24 * 60 * 60
+
+
+def get_shard(sender_id, shards):
+    return zlib.crc32(str(sender_id).encode()) % shards
+
+
+def parse_messaging_events(data):
+    events = []
+    for entry in data.get("entry", []):
+        for messaging_event in entry.get("messaging", []):
+            if messaging_event.get("message", {}).get("text"):
+                message_text = messaging_event["message"]["text"]
+            elif messaging_event.get("postback"):
+                message_text = messaging_event["postback"]["payload"]
+            else:
+                continue
+            events.append((messaging_event["sender"]["id"], message_text))
+    return events
+
+
+def enqueue_events(database, events, shards):
+    pipeline = database.pipeline(transaction=False)
+    enqueued_at = time.time()
+    for sender_id, message_text in events:
+        event = json.dumps({
+            "id": uuid4().hex,
+            "sender_id": sender_id,
+            "message_text": message_text,
+            "enqueued_at": enqueued_at,
+        })
+        pipeline.lpush(QUEUE_KEY.format(shard=get_shard(sender_id, shards)), event)
+    pipeline.hincrby(METRICS_KEY, "enqueued", len(events))
+    pipeline.execute()
+
+
+def get_queue_stats(database, shards):
+    pipeline = database.pipeline(transaction=False)
+    for shard in range(shards):
+        pipeline.llen(QUEUE_KEY.format(shard=shard))
+    pipeline.hgetall(METRICS_KEY)
+    *depths, metrics = pipeline.execute()
+
+    processed = int(metrics.get("processed", 0))
+    lag_total_ms = float(metrics.get("lag_total_ms", 0))
+    return {
+        "depth": sum(depths),
+        "depth_by_shard": depths,
+        "enqueued": int(metrics.get("enqueued", 0)),
+        "processed": processed,
+        "failed": int(metrics.get("failed", 0)),
+        "skipped": int(metrics.get("skipped", 0)),
+        "last_lag_ms": float(metrics.get("last_lag_ms", 0)),
+        "average_lag_ms": lag_total_ms / processed if processed else 0,
+    }
+
+
+class ShardWorker(threading.Thread):
+    def __init__(self, database, shard, handler, poll_timeout=5, max_retry_delay=30):
+        super().__init__(name=f"fb-worker-{shard}", daemon=True)
+        self.database = database
+        self.queue_key = QUEUE_KEY.format(shard=shard)
+        self.processing_key = PROCESSING_KEY.format(shard=shard)
+        self.handler = handler
+        self.poll_timeout = poll_timeout
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = 0
+        self.stopped = threading.Event()
+
+    def requeue_unfinished(self):
+        # Events a crashed worker took but never finished go back to the
+        # consuming end of the queue, ahead of anything newer.
+        unfinished_events = self.database.lrange(self.processing_key, 0, -1)
+        if unfinished_events:
+            pipeline = self.database.pipeline()
+            pipeline.rpush(self.queue_key, *unfinished_events)
+            pipeline.delete(self.processing_key)
+            pipeline.execute()
+
+    def run(self):
+        # A lost Redis connection must not end the thread: the shard's queue
+        # would keep growing with nobody draining it. Unfinished events are
+        # requeued on every restart; process() skips the ones that had
+        # already started, so retrying is safe.
+        while not self.stopped.is_set():
+            try:
+                self.requeue_unfinished()
+                self.consume()
+            except Exception as err:
+                self.retry_delay = min(max(self.retry_delay * 2, 1), self.max_retry_delay)
+                logger.warning(f"{self.name} failed: {err!r}, retrying in {self.retry_delay}s")
+                self.stopped.wait(self.retry_delay)
+
+    def consume(self):
+        while not self.stopped.is_set():
+            raw_event = self.database.brpoplpush(
+                self.queue_key, self.processing_key, timeout=self.poll_timeout
+            )
+            self.retry_delay = 0
+            if raw_event is None:
+                continue
+            self.process(raw_event)
+
+    def is_first_delivery(self, event):
+        # Handlers send messages and change carts, so an event that was
+        # requeued after its handler started is dropped rather than replayed:
+        # delivery is at most once.
+        event_id = event.get("id")
+        if event_id is None:
+            return True
+        started_key = STARTED_KEY.format(event_id=event_id)
+        return bool(self.database.set(started_key, 1, nx=True, ex=STARTED_TTL))
+
+    def process(self, raw_event):
+        lag_ms = 0
+        failed = 0
+        skipped = 0
+        try:
+            event = json.loads(raw_event)
+            lag_ms = (time.time() - event["enqueued_at"]) * 1000
+            if self.is_first_delivery(event):
+                self.handler(event["sender_id"], event["message_text"])
+            else:
+                skipped = 1
+                logger.warning(f"Skipped redelivered event {event['id']}")
+        except Exception as err:
+            failed = 1
+            logger.warning(f"Event {raw_event} failed: {err}")
+
+        pipeline = self.database.pipeline()
+        pipeline.lrem(self.processing_key, 1, raw_event)
+        pipeline.hincrby(METRICS_KEY, "processed", 1)
+        pipeline.hincrby(METRICS_KEY, "failed", failed)
+        pipeline.hincrby(METRICS_KEY, "skipped", skipped)
+        pipeline.hset(METRICS_KEY, "last_lag_ms", round(lag_ms, 1))
+        pipeline.hincrbyfloat(METRICS_KEY, "lag_total_ms", lag_ms)
+        pipeline.execute()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_workers(database, handler, shards):
+    workers = [ShardWorker(database, shard, handler) for shard in range(shards)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {shards} Facebook event workers")
+    return workers
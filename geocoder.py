@@ -0,0 +1,135 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import requests
+from yandex_geocoder import Client, InvalidKey, NothingFound, UnexpectedResponse
+
+
+YANDEX_GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x/"
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def normalize_address(address):
+    address = address.lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w]+", " ", address).split())
+
+
+class GeocoderClient(Client):
+    __slots__ = ("base_url", "session")
+
+    def __init__(self, api_key, base_url=YANDEX_GEOCODER_URL):
+        super().__init__(api_key)
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def _request(self, address):
+        response = self.session.get(
+            self.base_url,
+            params=dict(format="json", apikey=self.api_key, geocode=address),
+            timeout=(3.05, 10),
+        )
+
+        if response.status_code == 200:
+            return response.json()["response"]
+        elif response.status_code == 403:
+            raise InvalidKey()
+        else:
+            raise UnexpectedResponse(
+                f"status_code={response.status_code}, body={response.content}"
+            )
+
+
+class Geocoder:
+    def __init__(self, database, client, ttl=30 * 24 * 3600, negative_ttl=24 * 3600,
+                 local_size=2048):
+        self.database = database
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.local_size = local_size
+
+        self._local = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def coordinates(self, address):
+        key = normalize_address(address)
+
+        coordinates = self._get_local(key)
+        if coordinates is None:
+            with self._lock:
+                future = self._in_flight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = self._in_flight[key] = Future()
+            if is_leader:
+                try:
+                    future.set_result(self._lookup(key, address))
+                except Exception as err:
+                    future.set_exception(err)
+                finally:
+                    with self._lock:
+                        del self._in_flight[key]
+            coordinates = future.result()
+
+        if not coordinates:
+            raise NothingFound(f'Nothing found for "{address}"')
+        return coordinates
+
+    def _lookup(self, key, address):
+        stored_coordinates = self.database.get(f"geocode:{key}")
+        if stored_coordinates is not None:
+            coordinates = tuple(json.loads(stored_coordinates))
+            self._set_local(key, coordinates, self.ttl if coordinates else self.negative_ttl)
+            return coordinates
+
+        try:
+            lon, lat = self.client.coordinates(address)
+            coordinates = (float(lon), float(lat))
+            ttl = self.ttl
+        except NothingFound:
+            coordinates = ()
+            ttl = self.negative_ttl
+
+        self.database.set(f"geocode:{key}", json.dumps(coordinates), ex=ttl)
+        self._set_local(key, coordinates, ttl)
+        return coordinates
+
+    def _get_local(self, key):
+        with self._lock:
+            cached = self._local.get(key)
+            if cached is None:
+                return None
+            coordinates, expires_at = cached
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return coordinates
+
+    def _set_local(self, key, coordinates, ttl):
+        with self._lock:
+            self._local[key] = (coordinates, time.monotonic() + ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+
+def get_geocoder(database, api_key):
+    global _geocoder
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                client = GeocoderClient(
+                    api_key,
+                    base_url=os.getenv("YANDEX_GEOCODER_URL", YANDEX_GEOCODER_URL),
+                )
+                _geocoder = Geocoder(database, client)
+    return _geocoder
@@ -4,36 +4,42 @@ from pprint import pprint
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 
-def get_paginator(products, per_page):
-    items_per_page = per_page
-    max_page = len(products) // items_per_page
+MENU_PAGE_SIZE = 8
+
+_main_menu_cache = {}
+_main_menu_cache_version = None
+
 
-    start = 0
-    end = items_per_page
+def get_pages_count(products, per_page=MENU_PAGE_SIZE):
+    return max(1, -(-len(products) // per_page))
 
-    paginated_products = []
 
-    for _ in range(max_page):
-        paginated_products.append(products[start:end])
-        start = end
-        end += items_per_page
+def get_page(products, page, per_page=MENU_PAGE_SIZE):
+    start = page * per_page
+    return products[start:start + per_page]
 
-    return paginated_products
+
+def get_paginator(products, per_page):
+    return [
+        get_page(products, page, per_page)
+        for page in range(get_pages_count(products, per_page))
+    ]
 
 
-def get_main_menu(products, page=0):
-    products = get_paginator(products, 8)
+def build_main_menu(products, page=0, per_page=MENU_PAGE_SIZE):
+    max_page = get_pages_count(products, per_page) - 1
     inline_keyboard = [
-        [InlineKeyboardButton(product['name'], callback_data=product['id'])] for product in products[page]
+        [InlineKeyboardButton(product['name'], callback_data=product['id'])]
+        for product in get_page(products, page, per_page)
     ]
 
-    if page == len(products) - 1:
-        inline_keyboard.append([InlineKeyboardButton('Назад', callback_data=f'pag, {page - 1}')])
-    elif page == 0:
-        inline_keyboard.append([InlineKeyboardButton('Вперед', callback_data=f'pag, {page + 1}')])
-    else:
-        inline_keyboard.append([InlineKeyboardButton('Назад', callback_data=f'pag, {page - 1}'),
-                         InlineKeyboardButton('Вперед', callback_data=f'pag, {page + 1}')])
+    pagination_buttons = []
+    if page > 0:
+        pagination_buttons.append(InlineKeyboardButton('Назад', callback_data=f'pag, {page - 1}'))
+    if page < max_page:
+        pagination_buttons.append(InlineKeyboardButton('Вперед', callback_data=f'pag, {page + 1}'))
+    if pagination_buttons:
+        inline_keyboard.append(pagination_buttons)
 
     inline_keyboard.append([InlineKeyboardButton('Корзина', callback_data='cart')])
 
@@ -42,6 +48,24 @@ def get_main_menu(products, page=0):
     return inline_kb_markup
 
 
+def get_main_menu(products, page=0, per_page=MENU_PAGE_SIZE, version=None):
+    global _main_menu_cache, _main_menu_cache_version
+    if version is None:
+        return build_main_menu(products, page, per_page)
+
+    if version != _main_menu_cache_version:
+        _main_menu_cache = {}
+        _main_menu_cache_version = version
+
+    key = (page, per_page)
+    inline_kb_markup = _main_menu_cache.get(key)
+    if inline_kb_markup is None:
+        inline_kb_markup = build_main_menu(products, page, per_page)
+        _main_menu_cache[key] = inline_kb_markup
+
+    return inline_kb_markup
+
+
 def get_description_menu():
     inline_keyboard = [
         [InlineKeyboardButton('Добавить в корзину', callback_data=1)],
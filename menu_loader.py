@@ -0,0 +1,155 @@
+import json
+import logging
+import re
+
+
+logger = logging.getLogger(__name__)
+
+MENU_PATH = "pizzas_json/menu.json"
+ADDRESSES_PATH = "pizzas_json/addresses.json"
+
+_whitespace = re.compile(r"\s*")
+
+
+class MenuItem:
+    __slots__ = (
+        "id",
+        "name",
+        "description",
+        "price",
+        "image_url",
+        "fats",
+        "proteins",
+        "carbohydrates",
+        "kilocalories",
+        "weight",
+    )
+
+    def __init__(self, id, name, description, price, image_url, fats=None, proteins=None,
+                 carbohydrates=None, kilocalories=None, weight=None):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.price = price
+        self.image_url = image_url
+        self.fats = fats
+        self.proteins = proteins
+        self.carbohydrates = carbohydrates
+        self.kilocalories = kilocalories
+        self.weight = weight
+
+    @classmethod
+    def from_json(cls, item):
+        food_value = item.get("food_value") or {}
+        return cls(
+            id=int(item["id"]),
+            name=item["name"].strip(),
+            description=item["description"],
+            price=int(item["price"]),
+            image_url=item["product_image"]["url"],
+            fats=parse_decimal(food_value.get("fats")),
+            proteins=parse_decimal(food_value.get("proteins")),
+            carbohydrates=parse_decimal(food_value.get("carbohydrates")),
+            kilocalories=parse_decimal(food_value.get("kiloCalories")),
+            weight=food_value.get("weight"),
+        )
+
+
+class Pizzeria:
+    __slots__ = ("id", "alias", "address", "lat", "lon")
+
+    def __init__(self, id, alias, address, lat, lon):
+        self.id = id
+        self.alias = alias
+        self.address = address
+        self.lat = lat
+        self.lon = lon
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(
+            id=item["id"],
+            alias=item["alias"],
+            address=item["address"]["full"],
+            lat=parse_decimal(item["coordinates"]["lat"]),
+            lon=parse_decimal(item["coordinates"]["lon"]),
+        )
+
+
+def parse_decimal(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = value.replace(",", ".")
+    return float(value)
+
+
+def iter_json_array(path, chunk_size=64 * 1024):
+    # Decodes one element of the top-level array at a time, so only the
+    # current element and one chunk of text are held in memory.
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as fin:
+        buffer = fin.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array")
+        position = 1
+        eof = False
+        # What may come next: an element, or the closing bracket right after
+        # "[" or an element; everything else between elements must be one ",".
+        expect_element = True
+        allow_end = True
+        while True:
+            position = _whitespace.match(buffer, position).end()
+            if position >= len(buffer):
+                if eof:
+                    raise ValueError(f"{path} ends before the JSON array is closed")
+                chunk = fin.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            char = buffer[position]
+            if char == "]" and allow_end:
+                return
+            if not expect_element:
+                if char != ",":
+                    raise ValueError(f"{path}: expected ',' or ']' between elements, found {char!r}")
+                position += 1
+                expect_element = True
+                allow_end = False
+                continue
+            if char in ",]":
+                raise ValueError(f"{path}: expected an element, found {char!r}")
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = fin.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield element
+            position = end
+            expect_element = False
+            allow_end = True
+            if position > chunk_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+def iter_records(path, record_class):
+    for number, item in enumerate(iter_json_array(path)):
+        try:
+            yield record_class.from_json(item)
+        except (KeyError, TypeError, ValueError) as err:
+            logger.warning(f"Skipped invalid record {number} of {path}: {err!r}")
+
+
+def iter_menu(path=MENU_PATH):
+    return iter_records(path, MenuItem)
+
+
+def iter_addresses(path=ADDRESSES_PATH):
+    return iter_records(path, Pizzeria)
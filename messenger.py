@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_URL = "https://graph.facebook.com/v2.6"
+
+# Graph error codes meaning the request was rejected before delivery, so
+# sending it again cannot produce a duplicate message.
+TRANSIENT_ERROR_CODES = {1, 2, 4, 17, 341, 613}
+
+TEXT_MESSAGE = '{"text": %s}'
+
+_messenger_client = None
+_messenger_client_lock = threading.Lock()
+
+
+class TransientSendError(Exception):
+    pass
+
+
+class MessengerClient:
+    def __init__(self, page_access_token, base_url=GRAPH_API_URL, pool_size=10,
+                 timeout=(3.05, 15), retries=3, backoff=0.5, lock_stripes=64):
+        self.page_access_token = page_access_token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._recipient_locks = [threading.Lock() for _ in range(lock_stripes)]
+        self._outboxes = threading.local()
+
+    def _recipient_lock(self, recipient_id):
+        return self._recipient_locks[
+            zlib.crc32(str(recipient_id).encode()) % len(self._recipient_locks)
+        ]
+
+    @contextmanager
+    def outbox(self, recipient_id):
+        # Messages sent to recipient_id inside the block go out in one
+        # round trip on exit.
+        outbox = []
+        self._outboxes.current = (recipient_id, outbox)
+        try:
+            yield outbox
+        finally:
+            self._outboxes.current = None
+            if outbox:
+                self.send_many(recipient_id, outbox)
+
+    def send(self, recipient_id, message_json):
+        current = getattr(self._outboxes, "current", None)
+        if current is not None and current[0] == recipient_id:
+            current[1].append(message_json)
+            return
+        self.send_many(recipient_id, [message_json])
+
+    def send_text(self, recipient_id, message_text):
+        self.send(recipient_id, TEXT_MESSAGE % json.dumps(message_text))
+
+    def send_many(self, recipient_id, message_jsons):
+        recipient_json = json.dumps({"id": recipient_id})
+        with self._recipient_lock(recipient_id):
+            sent = 0
+            for attempt in range(self.retries + 1):
+                try:
+                    if len(message_jsons) - sent == 1:
+                        self._post_message(recipient_json, message_jsons[sent])
+                        sent += 1
+                    else:
+                        sent += self._post_batch(recipient_json, message_jsons[sent:])
+                    if sent == len(message_jsons):
+                        return
+                except (requests.ConnectionError, TransientSendError) as err:
+                    # Read timeouts are not retried: the message may already
+                    # have been delivered.
+                    if attempt == self.retries:
+                        raise
+                    logger.warning(f"Retrying send to {recipient_id}: {err}")
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+            raise TransientSendError(
+                f"Sent {sent} of {len(message_jsons)} messages to {recipient_id}"
+            )
+
+    def _post_message(self, recipient_json, message_json):
+        response = self.session.post(
+            f"{self.base_url}/me/messages",
+            params={"access_token": self.page_access_token},
+            headers={"Content-Type": "application/json"},
+            data=f'{{"recipient": {recipient_json}, "message": {message_json}}}'.encode(),
+            timeout=self.timeout,
+        )
+        # A 5xx is retried only when Graph marks the error as transient;
+        # others, like a rejected message, fail the same way every time.
+        if is_transient_error(response.text):
+            raise TransientSendError(f"status_code={response.status_code}, body={response.text}")
+        response.raise_for_status()
+
+    def _post_batch(self, recipient_json, message_jsons):
+        # Each request depends on the previous one, so Graph executes them in
+        # order and stops at the first failure. Returns how many got through.
+        batch = []
+        for number, message_json in enumerate(message_jsons):
+            operation = {
+                "method": "POST",
+                "relative_url": "me/messages",
+                "name": f"message{number}",
+                "omit_response_on_success": False,
+                "body": urlencode({"recipient": recipient_json, "message": message_json}),
+            }
+            if number:
+                operation["depends_on"] = f"message{number - 1}"
+            batch.append(operation)
+
+        response = self.session.post(
+            self.base_url,
+            data={
+                "access_token": self.page_access_token,
+                "batch": json.dumps(batch),
+                "include_headers": "false",
+            },
+            timeout=self.timeout,
+        )
+        if is_transient_error(response.text):
+            raise TransientSendError(f"status_code={response.status_code}, body={response.text}")
+        response.raise_for_status()
+
+        sent = 0
+        for result in response.json():
+            if result is None or is_transient_error(result["body"]):
+                break
+            if result["code"] >= 400:
+                raise requests.HTTPError(
+                    f"Message {sent} failed: code={result['code']}, body={result['body']}"
+                )
+            sent += 1
+        return sent
+
+    def close(self):
+        self.session.close()
+
+
+def is_transient_error(body):
+    try:
+        graph_error = json.loads(body).get("error")
+    except (ValueError, AttributeError):
+        return False
+    if not graph_error:
+        return False
+    return graph_error.get("is_transient") or graph_error.get("code") in TRANSIENT_ERROR_CODES
+
+
+def get_messenger_client():
+    global _messenger_client
+    if _messenger_client is None:
+        with _messenger_client_lock:
+            if _messenger_client is None:
+                _messenger_client = MessengerClient(
+                    os.getenv("PAGE_ACCESS_TOKEN"),
+                    base_url=os.getenv("GRAPH_API_URL", GRAPH_API_URL),
+                )
+    return _messenger_client
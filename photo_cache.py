@@ -0,0 +1,34 @@
+import logging
+
+from telegram.error import BadRequest
+
+
+logger = logging.getLogger(__name__)
+
+PHOTO_FILE_IDS_KEY = "tg_photo_file_ids"
+
+
+class PhotoFileIdCache:
+    # Telegram keeps every photo the bot has sent; resending it by file_id
+    # skips the download from the Moltin CDN. The image id is part of the
+    # field, so a new main image of a product is uploaded again.
+    def __init__(self, database):
+        self.database = database
+
+    def get_field(self, product_id, image_id):
+        return f"{product_id}:{image_id}"
+
+    def send_photo(self, bot, chat_id, product_id, image_id, image_url, **kwargs):
+        field = self.get_field(product_id, image_id)
+        file_id = self.database.hget(PHOTO_FILE_IDS_KEY, field)
+        if file_id:
+            try:
+                return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as err:
+                logger.warning(f"Cached photo of product {product_id} was rejected: {err}")
+                self.database.hdel(PHOTO_FILE_IDS_KEY, field)
+
+        message = bot.send_photo(chat_id=chat_id, photo=image_url, **kwargs)
+        if message.photo:
+            self.database.hset(PHOTO_FILE_IDS_KEY, field, message.photo[-1].file_id)
+        return message
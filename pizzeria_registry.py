@@ -0,0 +1,86 @@
+import json
+import logging
+import threading
+import time
+
+# shop imports this module for its sync command, so it is imported as a
+# module to keep the cycle safe in either import order.
+import shop
+from delivery import get_delivery_zones
+from utilits import PizzeriaIndex
+
+
+logger = logging.getLogger(__name__)
+
+_pizzeria_registry = None
+_pizzeria_registry_lock = threading.Lock()
+
+
+class PizzeriaRegistry:
+    def __init__(self, database, flow_slug="pizzeria", ttl=3600, local_ttl=300):
+        self.database = database
+        self.flow_slug = flow_slug
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+
+        self._index = None
+        self._stored_pizzerias = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return f"pizzerias:{self.flow_slug}"
+
+    def get_index(self, access_token):
+        if self._index is not None and time.monotonic() - self._loaded_at < self.local_ttl:
+            return self._index
+
+        with self._lock:
+            if self._index is not None and time.monotonic() - self._loaded_at < self.local_ttl:
+                return self._index
+
+            stored_pizzerias = self.database.get(self.key)
+            if stored_pizzerias is None:
+                stored_pizzerias = self.refresh(access_token)
+
+            # Keep the same index object while the flow is unchanged, so
+            # structures derived from it (delivery zones) are not rebuilt.
+            if self._index is None or stored_pizzerias != self._stored_pizzerias:
+                pizzerias = {
+                    address: (lat, lon) for address, lat, lon in json.loads(stored_pizzerias)
+                }
+                self._index = PizzeriaIndex(pizzerias)
+                self._stored_pizzerias = stored_pizzerias
+                # Start the delivery grid now rather than on the first quote.
+                get_delivery_zones(self._index)
+            self._loaded_at = time.monotonic()
+
+            return self._index
+
+    def refresh(self, access_token):
+        pizzerias = {
+            address: (float(lat), float(lon))
+            for address, (lat, lon) in shop.get_pizzerias(access_token, self.flow_slug).items()
+        }
+        compact_pizzerias = json.dumps(
+            [[address, lat, lon] for address, (lat, lon) in pizzerias.items()]
+        )
+        self.database.set(self.key, compact_pizzerias, ex=self.ttl)
+        logger.info(f"Loaded {len(pizzerias)} entries of flow {self.flow_slug}")
+
+        return compact_pizzerias
+
+    def invalidate(self):
+        self.database.delete(self.key)
+        with self._lock:
+            self._index = None
+
+
+def get_pizzeria_registry(database):
+    global _pizzeria_registry
+    if _pizzeria_registry is None:
+        with _pizzeria_registry_lock:
+            if _pizzeria_registry is None:
+                _pizzeria_registry = PizzeriaRegistry(database)
+    return _pizzeria_registry
@@ -0,0 +1,109 @@
+import contextvars
+import functools
+import logging
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+_request_cache = contextvars.ContextVar("request_cache", default=None)
+
+
+class RequestCache:
+    def __init__(self, name):
+        self.name = name
+        self.results = {}
+        self.saved_calls = 0
+        self.made_calls = 0
+
+
+@contextmanager
+def request_scope(name):
+    # Moltin reads made while handling one update are answered once; the
+    # results are shared between callers, so they must not be mutated.
+    cache = RequestCache(name)
+    reset_token = _request_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _request_cache.reset(reset_token)
+        if cache.saved_calls:
+            logger.info(
+                f"{cache.name}: saved {cache.saved_calls} of "
+                f"{cache.saved_calls + cache.made_calls} Moltin calls"
+            )
+
+
+def get_request_cache():
+    return _request_cache.get()
+
+
+def set_request_cache(cache):
+    _request_cache.set(cache)
+
+
+def _get_key(function, args, kwargs):
+    key = (function.__qualname__, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def memoized(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        cache = _request_cache.get()
+        key = cache and _get_key(function, args, kwargs)
+        if not key:
+            return function(*args, **kwargs)
+        if key in cache.results:
+            cache.saved_calls += 1
+            return cache.results[key]
+        cache.made_calls += 1
+        result = cache.results[key] = function(*args, **kwargs)
+        return result
+    return wrapper
+
+
+def async_memoized(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        cache = _request_cache.get()
+        key = cache and _get_key(function, args, kwargs)
+        if not key:
+            return await function(*args, **kwargs)
+        if key in cache.results:
+            cache.saved_calls += 1
+            return cache.results[key]
+        cache.made_calls += 1
+        result = cache.results[key] = await function(*args, **kwargs)
+        return result
+    return wrapper
+
+
+def invalidates(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            clear_request_cache()
+    return wrapper
+
+
+def async_invalidates(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            clear_request_cache()
+    return wrapper
+
+
+def clear_request_cache():
+    cache = _request_cache.get()
+    if cache is not None:
+        cache.results.clear()
@@ -0,0 +1,43 @@
+SESSION_TTL = 30 * 24 * 3600
+
+
+class Session:
+    # Everything the bots remember about a chat lives in one hash: it is
+    # read with one HGETALL per update and written back with one pipelined
+    # HMSET + EXPIRE, which also slides the expiry of active chats.
+    def __init__(self, database, key, data, ttl=SESSION_TTL):
+        self.database = database
+        self.key = key
+        self.data = data
+        self.ttl = ttl
+        self.changed = {}
+
+    @classmethod
+    def load(cls, database, key, ttl=SESSION_TTL):
+        return cls(database, key, database.hgetall(key), ttl)
+
+    def get(self, field, default=None):
+        return self.data.get(field, default)
+
+    def __getitem__(self, field):
+        return self.data[field]
+
+    def __setitem__(self, field, value):
+        self.data[field] = value
+        self.changed[field] = value
+
+    def save(self):
+        pipeline = self.database.pipeline()
+        if self.changed:
+            pipeline.hmset(self.key, self.changed)
+        pipeline.expire(self.key, self.ttl)
+        pipeline.execute()
+        self.changed = {}
+
+
+def load_tg_session(database, chat_id):
+    return Session.load(database, f"session:tg:{chat_id}")
+
+
+def load_fb_session(database, sender_id):
+    return Session.load(database, f"session:fb:{sender_id}")
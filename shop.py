@@ -1,73 +1,64 @@
+import argparse
 import json
+import logging
 import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import partial
 from pprint import pprint
 from uuid import uuid4
 
 from dotenv import load_dotenv
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import pizzeria_registry
+from menu_loader import iter_addresses, iter_menu
+from request_cache import invalidates, memoized
 
-def get_client_token_info(client_id, client_secret, grant_type):
-    url = "https://api.moltin.com/oauth/access_token"
-    data = {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "grant_type": grant_type,
-    }
-
-    response = requests.post(url, data=data)
-    response.raise_for_status()
-    client_token_info = response.json()
 
-    return client_token_info
+logger = logging.getLogger(__name__)
 
+MOLTIN_API_URL = "https://api.moltin.com"
 
-def upload_product_image(token, image_url):
-    url = "https://api.moltin.com/v2/files"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
-    files = {
-        "file_location": (None, image_url),
-    }
-    response = requests.post(url, headers=headers, files=files)
-    response.raise_for_status()
-    product_image_info = response.json()
+IMPORT_CHECKPOINT_PATH = ".import_checkpoint.jsonl"
 
-    return product_image_info["data"]["id"]
+# The Facebook menu cache in app.py and the version key of catalog.Catalog;
+# dropping them makes both bots rebuild their menus after an import.
+MENU_CACHE_KEYS = ("categories", "menu_elements", "catalog_version")
 
+PIZZERIA_FIELDS = (
+    ("Address", "Pizzeria address", "string"),
+    ("Alias", "Alias for pizzeria", "string"),
+    ("Longitude", "Longitude pizzeria coordinates", "float"),
+    ("Latitude", "Latitude pizzeria coordinates", "float"),
+)
+CUSTOMER_ADDRESS_FIELDS = (
+    ("Longitude", "Longitude pizzeria coordinates", "float"),
+    ("Latitude", "Latitude pizzeria coordinates", "float"),
+    ("Card-id", "ID", "integer"),
+)
 
-def add_product_image(token, product_id, image_id):
-    url = f"https://api.moltin.com/v2/products/{product_id}/relationships/main-image"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
-    json_data = {
-        "data": {
-            "type": "main_image",
-            "id": image_id,
-        },
-    }
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+_moltin_client = None
+_moltin_client_lock = threading.Lock()
 
 
-def create_product(token, product):
-    url = "https://api.moltin.com/v2/products"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
-    json_data = {
+def get_product_json_data(product):
+    return {
         "data": {
             "type": "product",
-            "name": product["name"],
+            "name": product.name,
             "slug": str(uuid4())[-12:],
-            "sku": "sk" + str(product["id"]),
-            "description": product["description"],
+            "sku": get_product_sku(product),
+            "description": product.description,
             "manage_stock": True,
             "price": [
                 {
-                    "amount": product["price"] * 100,
+                    "amount": product.price * 100,
                     "currency": "RUB",
                     "includes_tax": True,
                 },
@@ -77,333 +68,756 @@ def create_product(token, product):
         },
     }
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
 
-    stored_product = response.json()
-    stored_product_id = stored_product["data"]["id"]
-    product_image_url = product["product_image"]["url"]
-    product_image_id = upload_product_image(token, product_image_url)
+def get_pizzeria_entry_data(pizzeria):
+    return {
+        "type": "entry",
+        "address": pizzeria.address,
+        "alias": pizzeria.alias,
+        "longitude": pizzeria.lon,
+        "latitude": pizzeria.lat,
+        "courier_id": 111111111,
+    }
 
-    add_product_image(token, stored_product_id, product_image_id)
 
+def parse_pizzerias_location(pizzerias):
+    pizzerias_location = {}
 
-def add_flows_and_get_id(token, name, description):
-    url = "https://api.moltin.com/v2/flows"
-    slug = name.lower()
-    headers = {
-        "Authorization": f"{token}",
-    }
-    json_data = {
-        "data": {
-            "type": "flow",
+    for pizzeria in pizzerias["data"]:
+        address = pizzeria["address"]
+        lat = pizzeria["latitude"]
+        lon = pizzeria["longitude"]
+
+        pizzerias_location[address] = (lat, lon)
+
+    return pizzerias_location
+
+
+def parse_categories(shop_categories):
+    categories = {}
+    for category in shop_categories["data"]:
+        slug = category["slug"]
+        id = category["id"]
+        name = category["name"]
+        categories[slug] = {
+            "id": id,
             "name": name,
-            "slug": slug,
-            "description": description,
-            "enabled": True,
-        },
-    }
+        }
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+    return categories
 
-    flows = response.json()
 
-    return flows["data"]["id"]
+class FileLinkCache:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._links = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, file_ids):
+        with self._lock:
+            links = {}
+            for file_id in file_ids:
+                if file_id in self._links:
+                    self._links.move_to_end(file_id)
+                    links[file_id] = self._links[file_id]
+            return links
+
+    def update(self, links):
+        with self._lock:
+            self._links.update(links)
+            while len(self._links) > self.maxsize:
+                self._links.popitem(last=False)
+
+
+file_link_cache = FileLinkCache()
+
+
+class MoltinClient:
+    def __init__(self, base_url=MOLTIN_API_URL, pool_size=10, timeout=(3.05, 15), retries=2):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        # Only idempotent reads are retried: a repeated POST would create
+        # a second product, cart item or flow entry.
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json"})
+
+    def request(self, method, path, token=None, auth_scheme="Bearer", **kwargs):
+        headers = kwargs.pop("headers", {})
+        if token:
+            headers["Authorization"] = f"{auth_scheme} {token}" if auth_scheme else f"{token}"
+        kwargs.setdefault("timeout", self.timeout)
+
+        response = self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            headers=headers,
+            **kwargs,
+        )
+        response.raise_for_status()
+
+        return response
+
+    def close(self):
+        self.session.close()
+
+    def get_client_token_info(self, client_id, client_secret, grant_type):
+        data = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "grant_type": grant_type,
+        }
 
+        response = self.request("POST", "/oauth/access_token", data=data)
+        client_token_info = response.json()
 
-def create_flows_field(token, flow_id, field_name, field_description, field_type):
-    url = "https://api.moltin.com/v2/fields"
-    headers = {
-        "Authorization": f"{token}",
-    }
+        return client_token_info
 
-    json_data = {
-        "data": {
-            "type": "field",
-            "name": field_name,
-            "slug": field_name.lower(),
-            "field_type": field_type,
-            "description": field_description,
-            "required": True,
-            "enabled": True,
-            "relationships": {
-                "flow": {
-                    "data": {
-                        "type": "flow",
-                        "id": flow_id,
+    def upload_product_image(self, token, image_url):
+        files = {
+            "file_location": (None, image_url),
+        }
+        response = self.request("POST", "/v2/files", token, files=files)
+        product_image_info = response.json()
+
+        return product_image_info["data"]["id"]
+
+    def add_product_image(self, token, product_id, image_id):
+        json_data = {
+            "data": {
+                "type": "main_image",
+                "id": image_id,
+            },
+        }
+        self.request(
+            "POST",
+            f"/v2/products/{product_id}/relationships/main-image",
+            token,
+            json=json_data,
+        )
+
+    def add_product(self, token, product):
+        json_data = get_product_json_data(product)
+
+        response = self.request("POST", "/v2/products", token, json=json_data)
+
+        return response.json()["data"]["id"]
+
+    def create_product(self, token, product):
+        stored_product_id = self.add_product(token, product)
+        product_image_url = product.image_url
+        product_image_id = self.upload_product_image(token, product_image_url)
+
+        self.add_product_image(token, stored_product_id, product_image_id)
+
+    def add_flows_and_get_id(self, token, name, description):
+        slug = name.lower()
+        json_data = {
+            "data": {
+                "type": "flow",
+                "name": name,
+                "slug": slug,
+                "description": description,
+                "enabled": True,
+            },
+        }
+
+        response = self.request(
+            "POST", "/v2/flows", token, auth_scheme=None, json=json_data
+        )
+
+        flows = response.json()
+
+        return flows["data"]["id"]
+
+    def create_flows_field(self, token, flow_id, field_name, field_description, field_type):
+        json_data = {
+            "data": {
+                "type": "field",
+                "name": field_name,
+                "slug": field_name.lower(),
+                "field_type": field_type,
+                "description": field_description,
+                "required": True,
+                "enabled": True,
+                "relationships": {
+                    "flow": {
+                        "data": {
+                            "type": "flow",
+                            "id": flow_id,
+                        },
                     },
                 },
             },
-        },
-    }
+        }
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+        self.request("POST", "/v2/fields", token, auth_scheme=None, json=json_data)
+
+    def get_flow(self, token, flow_slug):
+        response = self.request("GET", f"/v2/flows/{flow_slug}", token)
+
+        return response.json()["data"]
+
+    def get_flow_fields(self, token, flow_slug):
+        response = self.request("GET", f"/v2/flows/{flow_slug}/fields", token)
+
+        return response.json()["data"]
+
+    def get_flow_entries(self, token, flow_slug, page_limit=100):
+        entries = []
+        offset = 0
+        while True:
+            params = {"page[limit]": page_limit, "page[offset]": offset}
+            response = self.request(
+                "GET", f"/v2/flows/{flow_slug}/entries", token, params=params
+            )
+            flow_entries = response.json()
+
+            page = flow_entries["data"]
+            entries.extend(page)
+            offset += len(page)
+            total = flow_entries.get("meta", {}).get("results", {}).get("total", offset)
+            if not page or offset >= total:
+                break
+
+        return entries
+
+    def add_pizzeria_info(self, token, flow_slug, pizzeria):
+        json_data = {"data": get_pizzeria_entry_data(pizzeria)}
+
+        self.request(
+            "POST",
+            f"/v2/flows/{flow_slug}/entries",
+            token,
+            auth_scheme=None,
+            json=json_data,
+        )
+
+    def update_pizzeria_info(self, token, flow_slug, entry_id, pizzeria):
+        json_data = {"data": dict(get_pizzeria_entry_data(pizzeria), id=entry_id)}
+
+        self.request(
+            "PUT",
+            f"/v2/flows/{flow_slug}/entries/{entry_id}",
+            token,
+            auth_scheme=None,
+            json=json_data,
+        )
+
+    def delete_flow_entry(self, token, flow_slug, entry_id):
+        self.request(
+            "DELETE",
+            f"/v2/flows/{flow_slug}/entries/{entry_id}",
+            token,
+            auth_scheme=None,
+        )
+
+    def add_customer_address(self, token, flow_slug, current_position, card_id):
+        latitude, longitude = current_position
+        json_data = {
+            "data": {
+                "type": "entry",
+                "longitude": longitude,
+                "latitude": latitude,
+                "card-id": card_id,
+            },
+        }
 
+        self.request(
+            "POST",
+            f"/v2/flows/{flow_slug}/entries",
+            token,
+            auth_scheme=None,
+            json=json_data,
+        )
+
+    @memoized
+    def get_products(self, token):
+        response = self.request("GET", "/v2/products/", token)
+        shop_data = response.json()
+
+        products = shop_data["data"]
+
+        return products
+
+    @memoized
+    def get_products_with_images(self, token, page_limit=100):
+        products = []
+        image_urls = {}
+        offset = 0
+        while True:
+            params = {
+                "include": "main_image",
+                "page[limit]": page_limit,
+                "page[offset]": offset,
+            }
+            response = self.request("GET", "/v2/products", token, params=params)
+            shop_data = response.json()
+
+            page = shop_data["data"]
+            products.extend(page)
+            for image in shop_data.get("included", {}).get("main_images", []):
+                image_urls[image["id"]] = image["link"]["href"]
+
+            offset += len(page)
+            total = shop_data.get("meta", {}).get("results", {}).get("total", offset)
+            if not page or offset >= total:
+                break
+
+        return products, image_urls
+
+    @memoized
+    def get_products_by_category(self, token, slug="basic"):
+        categories = self.get_categories(token)
+        category_id = categories[slug]["id"]
+
+        params = {
+            "filter": f"eq(category.id,{category_id})",
+        }
 
-def add_pizzeria_info(token, flow_slug, pizzeria):
-    url = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
-    headers = {
-        "Authorization": f"{token}",
-        "Content-Type": "application/json",
-    }
-    json_data = {
-        "data": {
-            "type": "entry",
-            "address": pizzeria["address"]["full"],
-            "alias": pizzeria["alias"],
-            "longitude": float(pizzeria["coordinates"]["lon"]),
-            "latitude": float(pizzeria["coordinates"]["lat"]),
-            "courier_id": 111111111,
-        },
-    }
+        response = self.request("GET", "/v2/products", token, params=params)
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+        products = response.json()["data"]
 
+        return products
 
-def add_customer_address(token, flow_slug, current_position, card_id):
-    latitude, longitude = current_position
-    url = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
-    headers = {
-        "Authorization": f"{token}",
-        "Content-Type": "application/json",
-    }
-    json_data = {
-        "data": {
-            "type": "entry",
-            "longitude": longitude,
-            "latitude": latitude,
-            "card-id": card_id,
-        },
-    }
+    @memoized
+    def get_product(self, token, product_id):
+        response = self.request("GET", f"/v2/products/{product_id}", token)
+        product = response.json()
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+        return product["data"]
 
+    def get_file_links(self, token, file_ids, batch_size=50):
+        file_ids = list(dict.fromkeys(file_ids))
+        links = file_link_cache.get_many(file_ids)
+        missing_file_ids = [file_id for file_id in file_ids if file_id not in links]
 
-def get_products(token):
-    url = "https://api.moltin.com/v2/products/"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+        for start in range(0, len(missing_file_ids), batch_size):
+            batch = missing_file_ids[start:start + batch_size]
+            params = {"filter": f"in(id,{','.join(batch)})"}
+            response = self.request("GET", "/v2/files", token, params=params)
+            fetched_links = {
+                file["id"]: file["link"]["href"] for file in response.json()["data"]
+            }
+            file_link_cache.update(fetched_links)
+            links.update(fetched_links)
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    shop_data = response.json()
+        return links
 
-    products = shop_data["data"]
+    @memoized
+    def get_file_link(self, token, file_id):
+        links = file_link_cache.get_many([file_id])
+        if file_id in links:
+            return links[file_id]
 
-    return products
+        response = self.request("GET", f"/v2/files/{file_id}", token)
+        link = response.json()["data"]["link"]["href"]
+        file_link_cache.update({file_id: link})
 
+        return link
 
-def get_products_by_category(token, slug="basic"):
-    categories = get_categories(token)
-    category_id = categories[slug]["id"]
-    url = "https://api.moltin.com/v2/products"
+    def get_product_image(self, token, product_data):
+        image_id = product_data["relationships"]["main_image"]["data"]["id"]
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+        return self.get_file_link(token, image_id)
 
-    params = {
-        "filter": f"eq(category.id,{category_id})",
-    }
+    def get_product_images(self, token, products):
+        image_ids = {
+            product["id"]: product["relationships"]["main_image"]["data"]["id"]
+            for product in products
+            if product.get("relationships", {}).get("main_image")
+        }
+        links = self.get_file_links(token, image_ids.values())
 
-    response = requests.get(url, headers=headers, params=params)
-    response.raise_for_status()
+        return {
+            product_id: links[image_id]
+            for product_id, image_id in image_ids.items()
+            if image_id in links
+        }
 
-    products = response.json()["data"]
+    def check_image_link(self, image_url):
+        try:
+            response = self.session.head(image_url, timeout=self.timeout, allow_redirects=True)
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as err:
+            logger.warning(f"Image {image_url} is unreachable: {err}")
+            return False
+
+    def check_image_link_in_background(self, image_url):
+        threading.Thread(target=self.check_image_link, args=(image_url,), daemon=True).start()
+
+    @invalidates
+    def add_to_cart(self, token, product_id, cart_id, quantity=1):
+        json_data = {
+            "data": {
+                "id": product_id,
+                "type": "cart_item",
+                "quantity": quantity,
+            },
+        }
 
-    return products
+        response = self.request("POST", f"/v2/carts/{cart_id}/items", token, json=json_data)
 
+        return response.json()
 
-def get_product(token, product_id):
-    url = f"https://api.moltin.com/v2/products/{product_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+    @memoized
+    def get_cart_items(self, token, cart_id):
+        response = self.request("GET", f"/v2/carts/{cart_id}/items", token)
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    product = response.json()
+        return response.json()["data"]
 
-    return product["data"]
+    @memoized
+    def get_cart_total_amount(self, token, cart_id):
+        response = self.request("GET", f"/v2/carts/{cart_id}", token)
 
+        return response.json()["data"]
 
-def get_product_image(token, product_data):
-    image_id = product_data["relationships"]["main_image"]["data"]["id"]
-    url = f"https://api.moltin.com/v2/files/{image_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+    @invalidates
+    def delete_cart_items(self, token, cart_id, item_id):
+        response = self.request("DELETE", f"/v2/carts/{cart_id}/items/{item_id}", token)
+
+        return response.json()
+
+    def create_customer(self, token, user_name, email):
+        json_data = {
+            "data": {
+                "type": "customer",
+                "name": user_name,
+                "email": email,
+            },
+        }
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    product_files = response.json()
-    image_url = product_files["data"]["link"]["href"]
+        self.request("POST", "/v2/customers", token, json=json_data)
 
-    image = requests.get(image_url)
-    image.raise_for_status()
+    @memoized
+    def get_pizzerias(self, token, flow_slug):
+        return parse_pizzerias_location({"data": self.get_flow_entries(token, flow_slug)})
 
-    return image_url
+    @memoized
+    def get_categories(self, token):
+        response = self.request("GET", "/v2/categories", token)
 
+        return parse_categories(response.json())
 
-def add_to_cart(token, product_id, cart_id, quantity=1):
-    url = f"https://api.moltin.com/v2/carts/{cart_id}/items"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
 
-    json_data = {
-        "data": {
-            "id": product_id,
-            "type": "cart_item",
-            "quantity": quantity,
-        },
-    }
+def connect_database():
+    return redis.Redis(
+        host=os.getenv("DATABASE_HOST"),
+        port=os.getenv("DATABASE_PORT"),
+        password=os.getenv("DATABASE_PASSWORD"),
+        decode_responses=True,
+    )
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
 
+def get_moltin_client():
+    global _moltin_client
+    if _moltin_client is None:
+        with _moltin_client_lock:
+            if _moltin_client is None:
+                _moltin_client = MoltinClient(
+                    base_url=os.getenv("MOLTIN_API_URL", MOLTIN_API_URL),
+                    pool_size=int(os.getenv("MOLTIN_POOL_SIZE", 10)),
+                )
+    return _moltin_client
 
-def get_cart_items(token, cart_id):
-    url = f"https://api.moltin.com/v2/carts/{cart_id}/items"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+def get_client_token_info(client_id, client_secret, grant_type):
+    return get_moltin_client().get_client_token_info(client_id, client_secret, grant_type)
 
-    return response.json()["data"]
 
+def upload_product_image(token, image_url):
+    return get_moltin_client().upload_product_image(token, image_url)
 
-def get_cart_total_amount(token, cart_id):
-    url = f"https://api.moltin.com/v2/carts/{cart_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+def add_product_image(token, product_id, image_id):
+    get_moltin_client().add_product_image(token, product_id, image_id)
 
-    return response.json()["data"]
 
+def create_product(token, product):
+    get_moltin_client().create_product(token, product)
 
-def delete_cart_items(token, cart_id, item_id):
-    url = f"https://api.moltin.com/v2/carts/{cart_id}/items/{item_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
 
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+def add_flows_and_get_id(token, name, description):
+    return get_moltin_client().add_flows_and_get_id(token, name, description)
 
 
-def create_customer(token, user_name, email):
-    url = "https://api.moltin.com/v2/customers"
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+def create_flows_field(token, flow_id, field_name, field_description, field_type):
+    get_moltin_client().create_flows_field(
+        token, flow_id, field_name, field_description, field_type
+    )
 
-    json_data = {
-        "data": {
-            "type": "customer",
-            "name": user_name,
-            "email": email,
-        },
-    }
 
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
+def add_pizzeria_info(token, flow_slug, pizzeria):
+    get_moltin_client().add_pizzeria_info(token, flow_slug, pizzeria)
 
 
-def get_addresses():
-    with open("pizzas_json/addresses.json", "r") as fin:
-        addresses = json.load(fin)
+def add_customer_address(token, flow_slug, current_position, card_id):
+    get_moltin_client().add_customer_address(token, flow_slug, current_position, card_id)
 
-    return addresses
 
+def get_products(token):
+    return get_moltin_client().get_products(token)
 
-def get_menu():
-    with open("pizzas_json/menu.json", "r") as fin:
-        menu = json.load(fin)
 
-    return menu
+def get_products_with_images(token):
+    return get_moltin_client().get_products_with_images(token)
 
 
-def add_products(token, menu):
-    for product in menu:
-        create_product(token, product)
+def get_products_by_category(token, slug="basic"):
+    return get_moltin_client().get_products_by_category(token, slug)
 
 
-def add_model_fields(token, flow_id):
-    # create_flows_field(token, flow_id, 'Address', 'Pizzeria address', 'string')
-    # create_flows_field(token, flow_id, 'Alias', 'Alias for pizzeria', 'string')
-    create_flows_field(
-        token, flow_id, "Longitude", "Longitude pizzeria coordinates", "float"
-    )
-    create_flows_field(
-        token, flow_id, "Latitude", "Latitude pizzeria coordinates", "float"
-    )
-    create_flows_field(token, flow_id, "Card-id", "ID", "integer")
+def get_product(token, product_id):
+    return get_moltin_client().get_product(token, product_id)
 
 
-def add_pizzerias(token, flow_slug, pizzerias):
-    for pizzeria in pizzerias:
-        add_pizzeria_info(token, flow_slug, pizzeria)
+def get_product_image(token, product_data):
+    return get_moltin_client().get_product_image(token, product_data)
 
 
-def get_pizzerias(token, flow_slug):
-    url = f"https://api.moltin.com/v2/flows/{flow_slug}/entries"
+def get_product_images(token, products):
+    return get_moltin_client().get_product_images(token, products)
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+def get_file_links(token, file_ids):
+    return get_moltin_client().get_file_links(token, file_ids)
 
-    pizzerias = response.json()
 
-    pizzerias_location = {}
+def add_to_cart(token, product_id, cart_id, quantity=1):
+    return get_moltin_client().add_to_cart(token, product_id, cart_id, quantity)
 
-    for pizzeria in pizzerias["data"]:
-        address = pizzeria["address"]
-        lat = pizzeria["latitude"]
-        lon = pizzeria["longitude"]
 
-        pizzerias_location[address] = (lat, lon)
+def get_cart_items(token, cart_id):
+    return get_moltin_client().get_cart_items(token, cart_id)
 
-    return pizzerias_location
 
+def get_cart_total_amount(token, cart_id):
+    return get_moltin_client().get_cart_total_amount(token, cart_id)
 
-def get_categories(token):
-    url = "https://api.moltin.com/v2/categories"
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-    }
+def delete_cart_items(token, cart_id, item_id):
+    return get_moltin_client().delete_cart_items(token, cart_id, item_id)
 
-    response = requests.get(
-        url,
-        headers=headers,
+
+def create_customer(token, user_name, email):
+    get_moltin_client().create_customer(token, user_name, email)
+
+
+def get_addresses():
+    return iter_addresses()
+
+
+def get_menu():
+    return iter_menu()
+
+
+def get_product_sku(product):
+    return "sk" + str(product.id)
+
+
+class ImportCheckpoint:
+    # Append-only log of finished import steps, one JSON line per step, so
+    # a rerun after a crash does not re-upload images. It is removed once an
+    # import finishes without failures.
+    def __init__(self, path):
+        self.path = path
+        self.steps = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as fin:
+                for line in fin:
+                    if line.strip():
+                        step = json.loads(line)
+                        self.steps.setdefault(step.pop("sku"), {}).update(step)
+
+    def get(self, sku):
+        with self._lock:
+            return dict(self.steps.get(sku, {}))
+
+    def save(self, sku, **fields):
+        with self._lock:
+            self.steps.setdefault(sku, {}).update(fields)
+            with open(self.path, "a") as fout:
+                fout.write(json.dumps(dict(fields, sku=sku)) + "\n")
+
+    def clear(self):
+        with self._lock:
+            self.steps = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def import_product(client, token, product, stored_product, checkpoint, upload_pool):
+    sku = get_product_sku(product)
+    if stored_product and stored_product.get("relationships", {}).get("main_image"):
+        return "skipped"
+
+    # The store is the source of truth: the checkpoint only helps to finish
+    # a product that exists there, and is ignored for a new or wiped store.
+    product_id = stored_product and stored_product["id"]
+    step = checkpoint.get(sku) if stored_product else {}
+
+    # The image upload does not depend on the product, so it runs while the
+    # product is being created.
+    image_id = step.get("image_id")
+    if not image_id:
+        uploaded_image = upload_pool.submit(
+            client.upload_product_image, token, product.image_url
+        )
+    try:
+        if not product_id:
+            product_id = client.add_product(token, product)
+    finally:
+        if not image_id:
+            image_id = uploaded_image.result()
+            checkpoint.save(sku, image_id=image_id)
+
+    client.add_product_image(token, product_id, image_id)
+    return "created"
+
+
+def add_products(token, menu, concurrency=4, checkpoint_path=IMPORT_CHECKPOINT_PATH):
+    client = get_moltin_client()
+    checkpoint = ImportCheckpoint(checkpoint_path)
+    stored_products, _ = client.get_products_with_images(token)
+    stored_products = {product.get("sku"): product for product in stored_products}
+
+    started_at = time.monotonic()
+    results = Counter()
+    imports = {}
+
+    def collect(finished_imports):
+        for finished_import in finished_imports:
+            product = imports.pop(finished_import)
+            try:
+                results[finished_import.result()] += 1
+            except Exception as err:
+                results["failed"] += 1
+                logger.warning(f"Product {product.id} was not imported: {err}")
+
+    # The menu is consumed lazily: only a few batches of products are
+    # queued at a time, however large the file is.
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="import") as product_pool, \
+            ThreadPoolExecutor(concurrency, thread_name_prefix="upload") as upload_pool:
+        for product in menu:
+            if len(imports) >= concurrency * 4:
+                collect(wait(imports, return_when=FIRST_COMPLETED).done)
+            imported = product_pool.submit(
+                import_product,
+                client,
+                token,
+                product,
+                stored_products.get(get_product_sku(product)),
+                checkpoint,
+                upload_pool,
+            )
+            imports[imported] = product
+        collect(as_completed(list(imports)))
+
+    if not results["failed"]:
+        checkpoint.clear()
+
+    elapsed = time.monotonic() - started_at
+    print(
+        f"Imported {results['created']} products, skipped {results['skipped']}, "
+        f"failed {results['failed']} in {elapsed:.1f}s "
+        f"({results['created'] / elapsed if elapsed else 0:.1f} products/s)"
     )
-    response.raise_for_status()
+    return results
 
-    categories = {}
-    for category in response.json()["data"]:
-        slug = category["slug"]
-        id = category["id"]
-        name = category["name"]
-        categories[slug] = {
-            "id": id,
-            "name": name,
+
+def add_model_fields(token, flow_id, flow_slug=None, fields=CUSTOMER_ADDRESS_FIELDS):
+    # Fields the flow already has are left alone, so the schema can be
+    # ensured before every sync.
+    existing_fields = set()
+    if flow_slug:
+        existing_fields = {
+            field["slug"] for field in get_moltin_client().get_flow_fields(token, flow_slug)
         }
+    for field_name, field_description, field_type in fields:
+        if field_name.lower() not in existing_fields:
+            create_flows_field(token, flow_id, field_name, field_description, field_type)
+
+
+def is_same_pizzeria(entry, pizzeria):
+    entry_data = get_pizzeria_entry_data(pizzeria)
+    return (
+        entry.get("address") == entry_data["address"]
+        and float(entry.get("longitude") or 0) == entry_data["longitude"]
+        and float(entry.get("latitude") or 0) == entry_data["latitude"]
+    )
 
-    return categories
+
+def add_pizzerias(token, flow_slug, pizzerias, concurrency=4):
+    client = get_moltin_client()
+    flow = client.get_flow(token, flow_slug)
+    add_model_fields(token, flow["id"], flow_slug, PIZZERIA_FIELDS)
+
+    pizzerias = {pizzeria.alias: pizzeria for pizzeria in pizzerias}
+    entries = {}
+    changes = []
+    for entry in client.get_flow_entries(token, flow_slug):
+        alias = entry.get("alias")
+        if alias not in pizzerias or alias in entries:
+            changes.append(("deleted", client.delete_flow_entry, entry["id"]))
+            continue
+        entries[alias] = entry
+    results = Counter()
+    for alias, pizzeria in pizzerias.items():
+        entry = entries.get(alias)
+        if entry is None:
+            changes.append(("created", client.add_pizzeria_info, pizzeria))
+        elif not is_same_pizzeria(entry, pizzeria):
+            update = partial(client.update_pizzeria_info, pizzeria=pizzeria)
+            changes.append(("updated", update, entry["id"]))
+        else:
+            results["unchanged"] += 1
+
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="sync") as pool:
+        syncs = {
+            pool.submit(apply_change, token, flow_slug, argument): change
+            for change, apply_change, argument in changes
+        }
+        for finished_sync in as_completed(syncs):
+            try:
+                finished_sync.result()
+                results[syncs[finished_sync]] += 1
+            except Exception as err:
+                results["failed"] += 1
+                logger.warning(f"Flow entry was not {syncs[finished_sync]}: {err}")
+
+    print(
+        f"Synced flow {flow_slug} in {time.monotonic() - started_at:.1f}s: "
+        f"created {results['created']}, updated {results['updated']}, "
+        f"deleted {results['deleted']}, unchanged {results['unchanged']}, "
+        f"failed {results['failed']}"
+    )
+    return results
+
+
+def get_pizzerias(token, flow_slug):
+    return get_moltin_client().get_pizzerias(token, flow_slug)
+
+
+def get_categories(token):
+    return get_moltin_client().get_categories(token)
 
 
 if __name__ == "__main__":
@@ -412,4 +826,19 @@ if __name__ == "__main__":
     client_secret = os.getenv("CLIENT_SECRET")
     grant_type = os.getenv("GRANT_TYPE")
 
+    parser = argparse.ArgumentParser(description="Load the menu and pizzerias into Moltin")
+    parser.add_argument("command", choices=["import-menu", "sync-pizzerias"])
+    parser.add_argument("--flow", default="pizzeria", help="Flow slug of the pizzerias")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
     token = get_client_token_info(client_id, client_secret, grant_type)["access_token"]
+    if args.command == "import-menu":
+        results = add_products(token, get_menu(), concurrency=args.concurrency)
+        if results["created"]:
+            connect_database().delete(*MENU_CACHE_KEYS)
+    else:
+        results = add_pizzerias(token, args.flow, get_addresses(), concurrency=args.concurrency)
+        if results["created"] or results["updated"] or results["deleted"]:
+            # The bots keep the flow in Redis for an hour; make them reload it.
+            pizzeria_registry.PizzeriaRegistry(connect_database(), args.flow).invalidate()
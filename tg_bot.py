@@ -1,12 +1,12 @@
 import json
 import logging
 import os
-from datetime import datetime
+import signal
+import threading
 from functools import partial
 from pprint import pprint
 from textwrap import dedent
 
-import redis
 from dotenv import load_dotenv
 from telegram import LabeledPrice
 from telegram.ext import (Filters,
@@ -16,26 +16,24 @@ from telegram.ext import (Filters,
                           MessageHandler,
                           PreCheckoutQueryHandler,
                           )
-from yandex_geocoder import Client, exceptions
+from yandex_geocoder import exceptions
 
+from cart_mirror import get_cart_mirror
+from catalog import get_catalog
+from delivery import get_delivery_zones
+from geocoder import get_geocoder
 from keyboard import (get_main_menu,
                       get_description_menu,
                       get_cart_menu,
                       get_delivery_menu,
                       )
-from shop import (get_client_token_info,
-                  get_products,
-                  get_product,
-                  get_product_image,
-                  add_to_cart,
-                  get_cart_items,
-                  get_cart_total_amount,
-                  delete_cart_items,
-                  create_customer,
-                  get_pizzerias,
-                  add_customer_address
-                  )
-from utilits import get_nearest_pizzeria
+from photo_cache import PhotoFileIdCache
+from pizzeria_registry import get_pizzeria_registry
+from request_cache import request_scope
+from session import load_tg_session
+from shop import add_customer_address, connect_database, create_customer
+from tg_workers import ShardConsumer, ShardRegistry, create_dispatcher
+from token_manager import get_token_manager
 
 
 
@@ -53,10 +51,8 @@ def error(state, error):
     logger.warning(f'State {state} caused error {error}')
 
 
-def get_cart_message(cart_id, access_token):
-    cart_items = get_cart_items(access_token, cart_id)
-    cart_total_amount = get_cart_total_amount(access_token, cart_id)
-    total_amount = cart_total_amount['meta']['display_price']['with_tax']['formatted']
+def get_cart_message(cart_items, cart):
+    total_amount = cart['meta']['display_price']['with_tax']['formatted']
 
     message = ''
 
@@ -82,16 +78,17 @@ def get_cart_message(cart_id, access_token):
     return message
 
 
-def start(context, update, products):
-    update.message.reply_text(
-        'Выберите пиццу:',
-        reply_markup=get_main_menu(products)
+def start(context, update, catalog):
+    context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text='Выберите пиццу:',
+        reply_markup=get_main_menu(catalog.products, version=catalog.version)
     )
 
     return 'HANDLE_MENU'
 
 
-def handle_menu(context, update, access_token, products):
+def handle_menu(context, update, access_token, catalog, session):
     query = update.callback_query
 
     if 'pag' in query.data:
@@ -100,15 +97,15 @@ def handle_menu(context, update, access_token, products):
             text='Выберите пиццу',
             chat_id=query.message.chat_id,
             message_id=query.message.message_id,
-            reply_markup=get_main_menu(products, int(page))
+            reply_markup=get_main_menu(catalog.products, int(page), version=catalog.version)
         )
 
         return 'HANDLE_MENU'
 
     elif query.data == 'cart':
         cart_id = query.message['chat']['id']
-        cart_items = get_cart_items(access_token, cart_id)
-        message = get_cart_message(cart_id, access_token)
+        cart_items, cart = get_cart_mirror(_database).get(access_token, cart_id)
+        message = get_cart_message(cart_items, cart)
 
         context.bot.send_message(
             chat_id=query.message.chat_id,
@@ -124,13 +121,8 @@ def handle_menu(context, update, access_token, products):
 
     else:
         product_id = query.data
-        user = f"user_tg_{query.message.chat_id}"
-        _database.set(
-            user,
-            json.dumps({'product_id': product_id})
-        )
-        context.user_data['product_id'] = product_id
-        product_data = get_product(access_token, product_id)
+        session['product_id'] = product_id
+        product_data = catalog.get_product(product_id)
         product_name = product_data['name']
         product_price = product_data['meta']['display_price']['with_tax']['formatted']
         product_description = product_data['description']
@@ -140,11 +132,12 @@ def handle_menu(context, update, access_token, products):
         {product_price}
         {product_description}
         '''
-        image_url = get_product_image(access_token, product_data)
-
-        context.bot.send_photo(
+        PhotoFileIdCache(_database).send_photo(
+            context.bot,
             chat_id=query.message.chat_id,
-            photo=image_url,
+            product_id=product_id,
+            image_id=catalog.get_image_id(product_id),
+            image_url=catalog.get_image_url(product_id),
             caption=dedent(message),
             reply_markup=get_description_menu()
         )
@@ -157,16 +150,15 @@ def handle_menu(context, update, access_token, products):
         return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(context, update, access_token, products):
+def handle_description(context, update, access_token, catalog, session):
     query = update.callback_query
-    user = f"user_tg_{query.message.chat_id}"
-    product_id = json.loads(_database.get(user))['product_id']
+    product_id = session['product_id']
 
     if query.data == 'back':
         context.bot.send_message(
             chat_id=query.message.chat_id,
             text='Please choose:',
-            reply_markup=get_main_menu(products)
+            reply_markup=get_main_menu(catalog.products, version=catalog.version)
         )
         context.bot.delete_message(
             chat_id=query.message.chat_id,
@@ -176,8 +168,8 @@ def handle_description(context, update, access_token, products):
 
     elif query.data == 'cart':
         cart_id = query.message['chat']['id']
-        cart_items = get_cart_items(access_token, cart_id)
-        message = get_cart_message(cart_id, access_token)
+        cart_items, cart = get_cart_mirror(_database).get(access_token, cart_id)
+        message = get_cart_message(cart_items, cart)
 
         context.bot.send_message(
             chat_id=query.message.chat_id,
@@ -192,14 +184,13 @@ def handle_description(context, update, access_token, products):
         return 'HANDLE_CART'
 
     elif query.data.isdigit():
-        add_to_cart(
-            token=access_token,
-            product_id=product_id,
+        get_cart_mirror(_database).add(
+            access_token,
             cart_id=query.message['chat']['id'],
+            product_id=product_id,
             quantity=int(query.data)
         )
-        product_data = get_product(access_token, product_id)
-        product_name = product_data['name']
+        product_name = catalog.get_product(product_id)['name']
         context.bot.answer_callback_query(
             callback_query_id=query.id,
             text=f'Вы добавили в корзину пиццу: {product_name}',
@@ -208,15 +199,15 @@ def handle_description(context, update, access_token, products):
         return 'HANDLE_DESCRIPTION'
 
 
-def handle_cart(context, update, access_token, products):
+def handle_cart(context, update, access_token, catalog):
     query = update.callback_query
     pay_with_price = query.data.split(', ')
     cart_id = query.message['chat']['id']
     if query.data.startswith('del'):
         item_id = query.data.split(' ')[-1]
-        delete_cart_items(access_token, cart_id, item_id)
-        cart_items = get_cart_items(access_token, cart_id)
-        message = get_cart_message(cart_id, access_token)
+        get_cart_mirror(_database).remove(access_token, cart_id, item_id)
+        cart_items, cart = get_cart_mirror(_database).get(access_token, cart_id)
+        message = get_cart_message(cart_items, cart)
         context.bot.send_message(
             chat_id=query.message.chat_id,
             text=dedent(message),
@@ -239,7 +230,7 @@ def handle_cart(context, update, access_token, products):
         context.bot.send_message(
             chat_id=query.message.chat_id,
             text='Please choose:',
-            reply_markup=get_main_menu(products)
+            reply_markup=get_main_menu(catalog.products, version=catalog.version)
         )
         context.bot.delete_message(
             chat_id=query.message.chat_id,
@@ -251,8 +242,7 @@ def handle_cart(context, update, access_token, products):
 def handle_waiting(context, update, yandex_token, access_token):
     if update.message.text:
         try:
-            client = Client(yandex_token)
-            lon, lat = client.coordinates(update.message.text)
+            lon, lat = get_geocoder(_database, yandex_token).coordinates(update.message.text)
             current_position = float(lat), float(lon)
         except exceptions.NothingFound:
             context.bot.send_message(
@@ -267,43 +257,14 @@ def handle_waiting(context, update, yandex_token, access_token):
             float(update.message.location.longitude)
         )
 
-    flow_slug = 'pizzeria'
-    pizzerias = get_pizzerias(access_token, flow_slug)
-    pizzeria_address, distance = get_nearest_pizzeria(current_position, pizzerias)
+    pizzerias = get_pizzeria_registry(_database).get_index(access_token)
+    quote = get_delivery_zones(pizzerias).quote(current_position)
     supplier = update.message.chat_id
 
-    if distance <= 0.5:
-        message_text = f'''
-        Может, заберете пиццу из нашей пиццерии неподалеку?
-        
-        Она всего в {(distance * 100):.2f} метрах от Вас!
-        Вот её адрес: {pizzeria_address}.
-        
-        А можем и бесплатно оставить, нам не сложно))
-        '''
-        reply_markup = get_delivery_menu(supplier, current_position)
-    elif 0.5 < distance <= 5:
-        message_text = f'''
-        Доставим Вашу пиццу за 100 рублей.
-        
-        Или можете забрать ее по адресу: {pizzeria_address}
-        '''
-        reply_markup = get_delivery_menu(supplier, current_position)
-    elif 5 < distance <= 20:
-        message_text = f'''
-        Доставим Вашу пиццу за 300 рублей.
-        
-        Или можете забрать ее по адресу: {pizzeria_address}
-        '''
+    message_text = quote.get_message()
+    if quote.deliverable:
         reply_markup = get_delivery_menu(supplier, current_position)
     else:
-        message_text = f'''
-        Простите, но так далеко мы пиццу не доставим.
-        
-        Ближайшая пиццерия аж в {distance:.2f} километрах от Вас.
-        
-        Заезжайте к нам в гости: {pizzeria_address}
-        '''
         reply_markup = None
 
     context.bot.send_message(
@@ -403,20 +364,8 @@ def successful_payment_callback(update, context):
 
 def handle_users_reply(update, context, client_id, client_secret, grant_type, yandex_token):
     db = get_database_connection()
-    if context.user_data.get('token_timestamp'):
-        diff = datetime.now() - context.user_data['token_timestamp']
-        if diff.total_seconds() >= get_client_token_info(client_id, client_secret, grant_type)['expires_in']:
-            context.user_data['token_timestamp'] = datetime.now()
-            context.user_data['access_token'] = get_client_token_info(client_id,
-                                                                      client_secret,
-                                                                      grant_type)['access_token']
-    else:
-        context.user_data['token_timestamp'] = datetime.now()
-        context.user_data['access_token'] = get_client_token_info(client_id,
-                                                                  client_secret,
-                                                                  grant_type)['access_token']
-    access_token = context.user_data['access_token']
-    products = get_products(access_token)
+    access_token = get_token_manager(db, client_id, client_secret, grant_type).get_access_token()
+    catalog = get_catalog(db).get(access_token)
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -425,23 +374,30 @@ def handle_users_reply(update, context, client_id, client_secret, grant_type, ya
         chat_id = update.callback_query.message.chat_id
     else:
         return
+    session = load_tg_session(db, chat_id)
+    # Chats without a session (new, or started before sessions existed)
+    # get the menu, whatever button they pressed.
     if user_reply == '/start':
         user_state = 'START'
     else:
-        user_state = db.get(chat_id)
+        user_state = session.get('state', 'START')
 
     states_functions = {
-        'START': partial(start, products=products),
-        'HANDLE_MENU': partial(handle_menu, access_token=access_token, products=products),
-        'HANDLE_DESCRIPTION': partial(handle_description, access_token=access_token, products=products),
-        'HANDLE_CART': partial(handle_cart, access_token=access_token, products=products),
+        'START': partial(start, catalog=catalog),
+        'HANDLE_MENU': partial(handle_menu, access_token=access_token, catalog=catalog, session=session),
+        'HANDLE_DESCRIPTION': partial(
+            handle_description, access_token=access_token, catalog=catalog, session=session
+        ),
+        'HANDLE_CART': partial(handle_cart, access_token=access_token, catalog=catalog),
         'HANDLE_WAITING': partial(handle_waiting, yandex_token=yandex_token, access_token=access_token),
         'HANDLE_DELIVERY': handle_delivery,
     }
-    state_handler = states_functions[user_state]
+    state_handler = states_functions.get(user_state, states_functions['START'])
     try:
-        next_state = state_handler(context, update)
-        db.set(chat_id, next_state)
+        with request_scope(f'Update from chat {chat_id}'):
+            next_state = state_handler(context, update)
+        session['state'] = next_state
+        session.save()
     except Exception as err:
         error(user_state, err)
 
@@ -449,31 +405,11 @@ def handle_users_reply(update, context, client_id, client_secret, grant_type, ya
 def get_database_connection():
     global _database
     if _database is None:
-        database_password = os.getenv("DATABASE_PASSWORD")
-        database_host = os.getenv("DATABASE_HOST")
-        database_port = os.getenv("DATABASE_PORT")
-        _database = redis.Redis(
-            host=database_host,
-            port=database_port,
-            password=database_password,
-            decode_responses=True,
-        )
+        _database = connect_database()
     return _database
 
 
-if __name__ == '__main__':
-    load_dotenv()
-    client_id = os.getenv('CLIENT_ID')
-    client_secret = os.getenv('CLIENT_SECRET')
-    grant_type = os.getenv('GRANT_TYPE')
-    tg_token = os.getenv('TELEGRAM_TOKEN')
-    yandex_token = os.getenv('YANDEX_TOKEN')
-    payment_token = os.getenv('PAYMENT_TOKEN')
-
-    updater = Updater(tg_token)
-    dispatcher = updater.dispatcher
-    jq = updater.job_queue
-
+def add_handlers(dispatcher, client_id, client_secret, grant_type, yandex_token):
     dispatcher.add_handler(CallbackQueryHandler(partial(
         handle_users_reply,
         client_id=client_id,
@@ -507,5 +443,44 @@ if __name__ == '__main__':
 
     dispatcher.add_error_handler(error)
 
-    updater.start_polling()
-    updater.idle()
+
+if __name__ == '__main__':
+    load_dotenv()
+    client_id = os.getenv('CLIENT_ID')
+    client_secret = os.getenv('CLIENT_SECRET')
+    grant_type = os.getenv('GRANT_TYPE')
+    tg_token = os.getenv('TELEGRAM_TOKEN')
+    yandex_token = os.getenv('YANDEX_TOKEN')
+    payment_token = os.getenv('PAYMENT_TOKEN')
+    tg_workers = int(os.getenv('TG_WORKERS', 8))
+    webhook_url = os.getenv('TG_WEBHOOK_URL')
+    shard = os.getenv('TG_SHARD')
+
+    dispatcher = create_dispatcher(tg_token, tg_workers)
+    add_handlers(dispatcher, client_id, client_secret, grant_type, yandex_token)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+
+    if shard:
+        # Updates come from tg_router through this shard's Redis queue.
+        database = get_database_connection()
+        consumer = ShardConsumer(database, dispatcher, shard, ShardRegistry(database))
+        dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+        dispatcher_thread.start()
+        dispatcher.job_queue.start()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: consumer.leave())
+        consumer.run()
+        dispatcher.job_queue.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()
+    elif webhook_url:
+        updater.start_webhook(
+            listen=os.getenv('TG_WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('TG_WEBHOOK_PORT', 8443)),
+            url_path=tg_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{tg_token}",
+        )
+        updater.idle()
+    else:
+        updater.start_polling()
+        updater.idle()
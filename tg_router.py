@@ -0,0 +1,40 @@
+import logging
+import os
+
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import TypeHandler, Updater
+
+from tg_bot import get_database_connection
+from tg_workers import ShardRegistry, ShardRouter
+
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    tg_token = os.getenv('TELEGRAM_TOKEN')
+    webhook_url = os.getenv('TG_WEBHOOK_URL')
+
+    database = get_database_connection()
+    router = ShardRouter(database, ShardRegistry(database))
+
+    updater = Updater(tg_token)
+    updater.dispatcher.add_handler(TypeHandler(Update, lambda update, context: router.route(update)))
+
+    if webhook_url:
+        updater.start_webhook(
+            listen=os.getenv('TG_WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('TG_WEBHOOK_PORT', 8443)),
+            url_path=tg_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{tg_token}",
+        )
+    else:
+        updater.start_polling()
+    updater.idle()
@@ -0,0 +1,386 @@
+import bisect
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import Dispatcher, ExtBot, JobQueue
+from telegram.utils.request import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+class ChatOrderedExecutor:
+    # Every chat is pinned to one worker thread, so its updates run one
+    # after another while different chats are handled in parallel.
+    def __init__(self, workers, name="chat-worker"):
+        self.queues = [Queue() for _ in range(workers)]
+        self.threads = [
+            threading.Thread(
+                target=self._work,
+                args=(worker_queue, ),
+                name=f"{name}-{number}",
+                daemon=True,
+            )
+            for number, worker_queue in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, function, *args):
+        worker_queue = self.queues[zlib.crc32(str(chat_id).encode()) % len(self.queues)]
+        worker_queue.put((function, args))
+
+    def _work(self, worker_queue):
+        while True:
+            task = worker_queue.get()
+            if task is None:
+                break
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                logger.exception(f"Task {function.__name__} failed")
+            finally:
+                worker_queue.task_done()
+
+    def join(self):
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def stop(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    def __init__(self, *args, chat_workers=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_executor = ChatOrderedExecutor(chat_workers)
+        # Called with every update once its handlers have finished.
+        self.processed_callbacks = []
+
+    def process_update(self, update):
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+        self.chat_executor.submit(get_update_chat_id(update), self._process_in_order, update)
+
+    def _process_in_order(self, update):
+        try:
+            super().process_update(update)
+        finally:
+            for callback in self.processed_callbacks:
+                callback(update)
+
+    def stop(self):
+        super().stop()
+        self.chat_executor.stop()
+
+
+def create_dispatcher(token, chat_workers, base_url=None):
+    # Every worker can hold a connection to the Bot API at once, plus the
+    # dispatcher, updater, job queue and main threads.
+    request = Request(con_pool_size=chat_workers + 4)
+    bot = ExtBot(token, base_url=base_url, request=request)
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot,
+        Queue(),
+        job_queue=job_queue,
+        chat_workers=chat_workers,
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return dispatcher
+
+
+SHARDS_KEY = "tg_shards"
+LEAVING_SHARDS_KEY = "tg_shards_leaving"
+SHARD_QUEUE_KEY = "tg_updates:{shard}"
+PENDING_QUEUE_KEY = "tg_updates:pending"
+CHAT_OWNERS_KEY = "tg_chat_owners"
+CHAT_UNFINISHED_KEY = "tg_chat_unfinished"
+SHARD_CHATS_KEY = "tg_shard_chats:{shard}"
+
+# Queues an update on the shard that still has unfinished updates of the
+# chat, or else on the shard the ring picked, and counts it as unfinished.
+CLAIM_SCRIPT = """
+local shard = ARGV[2]
+if redis.call('HINCRBY', KEYS[2], ARGV[1], 1) > 1 then
+    shard = redis.call('HGET', KEYS[1], ARGV[1]) or shard
+end
+redis.call('HSET', KEYS[1], ARGV[1], shard)
+redis.call('SADD', ARGV[4] .. shard, ARGV[1])
+redis.call('RPUSH', ARGV[5] .. shard, ARGV[3])
+return shard
+"""
+
+# Marks one update of the chat as processed; the chat is free to move to
+# another shard once none are left.
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+if redis.call('HINCRBY', KEYS[2], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('SREM', ARGV[3] .. ARGV[2], ARGV[1])
+end
+return 1
+"""
+
+
+class HashRing:
+    # Consistent hashing with virtual nodes: a shard joining or leaving only
+    # moves the chats between its points and their neighbours.
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.nodes = set()
+        self.points = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def get_hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            bisect.insort(self.points, (self.get_hash(f"{node}#{replica}"), node))
+
+    def remove(self, node):
+        self.nodes.discard(node)
+        self.points = [point for point in self.points if point[1] != node]
+
+    def get_node(self, key):
+        if not self.points:
+            return None
+        position = bisect.bisect(self.points, (self.get_hash(key), ))
+        return self.points[position % len(self.points)][1]
+
+
+class ShardRegistry:
+    def __init__(self, database, heartbeat_interval=5, timeout=15):
+        self.database = database
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+
+    def heartbeat(self, shard):
+        self.database.zadd(SHARDS_KEY, {shard: time.time()})
+
+    def mark_leaving(self, shard):
+        self.database.sadd(LEAVING_SHARDS_KEY, shard)
+
+    def deregister(self, shard):
+        pipeline = self.database.pipeline()
+        pipeline.zrem(SHARDS_KEY, shard)
+        pipeline.srem(LEAVING_SHARDS_KEY, shard)
+        pipeline.execute()
+
+    def get_live_shards(self):
+        return self.database.zrangebyscore(SHARDS_KEY, time.time() - self.timeout, "+inf")
+
+    def get_leaving_shards(self):
+        return self.database.smembers(LEAVING_SHARDS_KEY)
+
+    def get_dead_shards(self):
+        return self.database.zrangebyscore(SHARDS_KEY, "-inf", time.time() - self.timeout)
+
+
+class ChatOwners:
+    # A chat belongs to one shard from its first queued update until its last
+    # one is processed. Only then can it follow the ring to another shard, so
+    # two shards never handle the same chat at once.
+    def __init__(self, database):
+        self.database = database
+        self._claim = database.register_script(CLAIM_SCRIPT)
+        self._release = database.register_script(RELEASE_SCRIPT)
+
+    def claim(self, chat_id, shard, raw_update):
+        owner = self._claim(
+            keys=[CHAT_OWNERS_KEY, CHAT_UNFINISHED_KEY],
+            args=[
+                chat_id,
+                shard,
+                raw_update,
+                SHARD_CHATS_KEY.format(shard=""),
+                SHARD_QUEUE_KEY.format(shard=""),
+            ],
+        )
+        return owner.decode() if isinstance(owner, bytes) else owner
+
+    def release(self, chat_id, shard):
+        self._release(
+            keys=[CHAT_OWNERS_KEY, CHAT_UNFINISHED_KEY],
+            args=[chat_id, shard, SHARD_CHATS_KEY.format(shard="")],
+        )
+
+    def count(self, shard):
+        return self.database.scard(SHARD_CHATS_KEY.format(shard=shard))
+
+    def take_over(self, shard):
+        # Forgets the chats of a dead shard and returns its queued updates,
+        # in order, to be claimed again.
+        queue_key = SHARD_QUEUE_KEY.format(shard=shard)
+        chats_key = SHARD_CHATS_KEY.format(shard=shard)
+        pipeline = self.database.pipeline()
+        pipeline.lrange(queue_key, 0, -1)
+        pipeline.delete(queue_key)
+        pipeline.smembers(chats_key)
+        pipeline.delete(chats_key)
+        raw_updates, _, chats, _ = pipeline.execute()
+        if chats:
+            pipeline = self.database.pipeline()
+            pipeline.hdel(CHAT_OWNERS_KEY, *chats)
+            pipeline.hdel(CHAT_UNFINISHED_KEY, *chats)
+            pipeline.execute()
+        return raw_updates
+
+
+class ShardRouter:
+    # Assumes a single router: pushes and takeovers of dead shards are
+    # serialized by its lock.
+    def __init__(self, database, registry, refresh_interval=2):
+        self.database = database
+        self.registry = registry
+        self.owners = ChatOwners(database)
+        self.refresh_interval = refresh_interval
+        self.ring = HashRing()
+        self._refreshed_at = 0
+        self._lock = threading.RLock()
+
+    def route(self, update):
+        self.push(get_update_chat_id(update), update.to_dict())
+
+    def push(self, chat_id, update_data):
+        raw_update = json.dumps({"chat_id": chat_id, "update": update_data})
+        with self._lock:
+            self.refresh()
+            self._push(chat_id, raw_update)
+
+    def _push(self, chat_id, raw_update):
+        shard = self.ring.get_node(chat_id)
+        if shard is None:
+            self.database.rpush(PENDING_QUEUE_KEY, raw_update)
+            return
+        self.owners.claim(chat_id, shard, raw_update)
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            self._refreshed_at = time.monotonic()
+
+            # Leaving shards get no new chats but keep the ones they own
+            # until those are finished.
+            ring_shards = (
+                set(self.registry.get_live_shards()) - set(self.registry.get_leaving_shards())
+            )
+            for shard in self.ring.nodes - ring_shards:
+                self.ring.remove(shard)
+                logger.info(f"Shard {shard} left")
+            for shard in ring_shards - self.ring.nodes:
+                self.ring.add(shard)
+                logger.info(f"Shard {shard} joined")
+
+            if not ring_shards:
+                return
+            self._reroute(self._pop_all(PENDING_QUEUE_KEY))
+            for shard in self.registry.get_dead_shards():
+                self._reroute(self.owners.take_over(shard))
+                self.registry.deregister(shard)
+                logger.info(f"Took over the chats of dead shard {shard}")
+
+    def _pop_all(self, queue_key):
+        pipeline = self.database.pipeline()
+        pipeline.lrange(queue_key, 0, -1)
+        pipeline.delete(queue_key)
+        raw_updates, _ = pipeline.execute()
+        return raw_updates
+
+    def _reroute(self, raw_updates):
+        # Updates left behind keep their relative order on the shards that
+        # take over their chats.
+        for raw_update in raw_updates:
+            self._push(json.loads(raw_update)["chat_id"], raw_update)
+
+
+class ShardConsumer:
+    def __init__(self, database, dispatcher, shard, registry, poll_timeout=1, drain_grace=5):
+        self.database = database
+        self.dispatcher = dispatcher
+        self.shard = shard
+        self.queue_key = SHARD_QUEUE_KEY.format(shard=shard)
+        self.registry = registry
+        self.owners = ChatOwners(database)
+        self.poll_timeout = poll_timeout
+        self.drain_grace = drain_grace
+        self.leaving = threading.Event()
+        self.stopped = threading.Event()
+        dispatcher.processed_callbacks.append(self.release)
+
+    def _heartbeat_forever(self):
+        while not self.stopped.is_set():
+            self.registry.heartbeat(self.shard)
+            self.stopped.wait(self.registry.heartbeat_interval)
+
+    def release(self, update):
+        self.owners.release(get_update_chat_id(update), self.shard)
+
+    def run(self):
+        self.registry.heartbeat(self.shard)
+        heartbeat_thread = threading.Thread(target=self._heartbeat_forever, daemon=True)
+        heartbeat_thread.start()
+        logger.info(f"Shard {self.shard} is consuming {self.queue_key}")
+
+        left_at = None
+        while True:
+            if left_at is None and self.leaving.is_set():
+                self.registry.mark_leaving(self.shard)
+                left_at = time.monotonic()
+                logger.info(f"Shard {self.shard} is leaving, finishing its chats")
+
+            raw_update = self.database.blpop(self.queue_key, timeout=self.poll_timeout)
+            if raw_update is not None:
+                envelope = json.loads(raw_update[1])
+                self.dispatcher.update_queue.put(
+                    Update.de_json(envelope["update"], self.dispatcher.bot)
+                )
+                continue
+            # Routers keep giving new chats to this shard until their next
+            # refresh, and the chats it owns may still send updates; it stays
+            # until the grace period is over and every chat is finished.
+            if (
+                left_at is not None
+                and time.monotonic() - left_at > self.drain_grace
+                and not self.owners.count(self.shard)
+            ):
+                break
+
+        self.stopped.set()
+        heartbeat_thread.join()
+        self.registry.deregister(self.shard)
+        logger.info(f"Shard {self.shard} left")
+
+    def leave(self):
+        self.leaving.set()
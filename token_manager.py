@@ -0,0 +1,134 @@
+import logging
+import random
+import threading
+import time
+
+import redis
+
+from shop import get_client_token_info
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_KEY = "moltin_token"
+REFRESH_LOCK_KEY = "moltin_token_refresh_lock"
+
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+
+class TokenManager:
+    def __init__(self, database, client_id, client_secret, grant_type,
+                 refresh_margin=300, lock_timeout=30):
+        self.database = database
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.grant_type = grant_type
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+
+        self._access_token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._background_refresh = None
+        self._timer = None
+
+    def get_access_token(self):
+        now = time.time()
+        if self._access_token and now < self._expires_at - self.refresh_margin:
+            return self._access_token
+
+        if self._access_token and now < self._expires_at:
+            self._refresh_in_background()
+            return self._access_token
+
+        return self.refresh()
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._is_fresh():
+                return self._access_token
+
+            if not force and self._load() and self._is_fresh():
+                return self._access_token
+
+            # Several gunicorn workers may reach this point at once; only the
+            # one holding the lock asks Moltin, the rest reuse its token.
+            lock = self.database.lock(
+                REFRESH_LOCK_KEY,
+                timeout=self.lock_timeout,
+                blocking_timeout=self.lock_timeout,
+            )
+            acquired = lock.acquire(blocking=True)
+            try:
+                if not force and self._load() and self._is_fresh():
+                    return self._access_token
+                self._fetch()
+            finally:
+                if acquired:
+                    try:
+                        lock.release()
+                    except redis.exceptions.LockError:
+                        logger.warning("Moltin token refresh lock expired before release")
+
+            return self._access_token
+
+    def _is_fresh(self):
+        return bool(self._access_token) and time.time() < self._expires_at - self.refresh_margin
+
+    def _load(self):
+        stored_token = self.database.hgetall(TOKEN_KEY)
+        if not stored_token:
+            return False
+        self._set(stored_token["access_token"], float(stored_token["expires_at"]))
+        return True
+
+    def _fetch(self):
+        token_info = get_client_token_info(self.client_id, self.client_secret, self.grant_type)
+        expires_at = token_info.get("expires") or time.time() + token_info["expires_in"]
+
+        pipeline = self.database.pipeline()
+        pipeline.hmset(TOKEN_KEY, {
+            "access_token": token_info["access_token"],
+            "expires_at": expires_at,
+        })
+        pipeline.expireat(TOKEN_KEY, int(expires_at))
+        pipeline.execute()
+
+        self._set(token_info["access_token"], float(expires_at))
+        logger.info("Moltin access token refreshed")
+
+    def _set(self, access_token, expires_at):
+        self._access_token = access_token
+        self._expires_at = expires_at
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        # Jitter keeps workers that loaded the same token from waking together.
+        delay = self._expires_at - self.refresh_margin - time.time() + random.uniform(0, 30)
+        self._timer = threading.Timer(max(delay, 1), self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        if self._background_refresh is not None and self._background_refresh.is_alive():
+            return
+        self._background_refresh = threading.Thread(target=self._safe_refresh, daemon=True)
+        self._background_refresh.start()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as err:
+            logger.warning(f"Background Moltin token refresh failed: {err}")
+
+
+def get_token_manager(database, client_id, client_secret, grant_type):
+    global _token_manager
+    if _token_manager is None:
+        with _token_manager_lock:
+            if _token_manager is None:
+                _token_manager = TokenManager(database, client_id, client_secret, grant_type)
+    return _token_manager
@@ -1,32 +1,151 @@
-import requests
+import heapq
+import math
+
 from geopy import distance
 
 
-def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
-    response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']['featureMember']
+EARTH_RADIUS_KM = 6371.0088
+# Great-circle distance on the mean sphere differs from the WGS-84 geodesic
+# by well under 0.7%, so every candidate within this factor of the best
+# spherical match is re-ranked with the exact geodesic.
+SPHERE_ERROR = 1.007
+
+_pizzeria_index_cache = None
+
+
+def to_unit_vector(position):
+    lat, lon = map(math.radians, map(float, position))
+    cos_lat = math.cos(lat)
+    return cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat)
+
+
+def km_to_chord(km):
+    angle = min(km / EARTH_RADIUS_KM, math.pi)
+    return 2 * math.sin(angle / 2)
+
+
+def chord_to_km(chord):
+    return 2 * math.asin(min(chord / 2, 1.0)) * EARTH_RADIUS_KM
+
+
+class PizzeriaIndex:
+    def __init__(self, pizzerias):
+        self.names = list(pizzerias)
+        self.positions = [tuple(map(float, pizzerias[name])) for name in self.names]
+        self.points = [to_unit_vector(position) for position in self.positions]
+        self.tree = self._build(list(range(len(self.points))), 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _build(self, indexes, depth):
+        if not indexes:
+            return None
+        axis = depth % 3
+        indexes.sort(key=lambda index: self.points[index][axis])
+        middle = len(indexes) // 2
+        return (
+            indexes[middle],
+            axis,
+            self._build(indexes[:middle], depth + 1),
+            self._build(indexes[middle + 1:], depth + 1),
+        )
+
+    def _k_nearest_chords(self, point, k):
+        best = []
+
+        def visit(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            candidate = self.points[index]
+            squared_chord = (
+                (candidate[0] - point[0]) ** 2
+                + (candidate[1] - point[1]) ** 2
+                + (candidate[2] - point[2]) ** 2
+            )
+            if len(best) < k:
+                heapq.heappush(best, (-squared_chord, index))
+            elif squared_chord < -best[0][0]:
+                heapq.heapreplace(best, (-squared_chord, index))
+
+            delta = point[axis] - candidate[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            visit(near)
+            if len(best) < k or delta * delta < -best[0][0]:
+                visit(far)
+
+        visit(self.tree)
+        return sorted((math.sqrt(-squared_chord), index) for squared_chord, index in best)
+
+    def _within_chord(self, point, max_chord):
+        max_squared_chord = max_chord * max_chord
+        found = []
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            index, axis, left, right = node
+            candidate = self.points[index]
+            squared_chord = (
+                (candidate[0] - point[0]) ** 2
+                + (candidate[1] - point[1]) ** 2
+                + (candidate[2] - point[2]) ** 2
+            )
+            if squared_chord <= max_squared_chord:
+                found.append(index)
+
+            delta = point[axis] - candidate[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            stack.append(near)
+            if abs(delta) <= max_chord:
+                stack.append(far)
+        return found
+
+    def _refine(self, position, indexes):
+        return sorted(
+            (distance.distance(position, self.positions[index]).km, self.names[index])
+            for index in indexes
+        )
+
+    def k_nearest(self, position, k=1):
+        if not self.names or k <= 0:
+            return []
+        point = to_unit_vector(position)
+        nearest_chords = self._k_nearest_chords(point, min(k, len(self.names)))
+        farthest_km = chord_to_km(nearest_chords[-1][0])
+        candidates = self._within_chord(point, km_to_chord(farthest_km * SPHERE_ERROR + 1e-6))
+
+        return [
+            (name, round(distance_km, 3))
+            for distance_km, name in self._refine(position, candidates)[:k]
+        ]
+
+    def within_radius(self, position, radius_km):
+        point = to_unit_vector(position)
+        candidates = self._within_chord(point, km_to_chord(radius_km * SPHERE_ERROR))
+
+        return [
+            (name, round(distance_km, 3))
+            for distance_km, name in self._refine(position, candidates)
+            if distance_km <= radius_km
+        ]
+
+    def nearest(self, position):
+        return self.k_nearest(position, 1)[0]
+
 
-    if not found_places:
-        return None
+def get_pizzeria_index(pizzerias):
+    global _pizzeria_index_cache
+    if isinstance(pizzerias, PizzeriaIndex):
+        return pizzerias
 
-    most_relevant = found_places[0]
-    lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
-    return lon, lat
+    key = tuple((name, tuple(position)) for name, position in pizzerias.items())
+    if _pizzeria_index_cache is None or _pizzeria_index_cache[0] != key:
+        _pizzeria_index_cache = (key, PizzeriaIndex(pizzerias))
+    return _pizzeria_index_cache[1]
 
 
 def get_nearest_pizzeria(customer_position, pizzerias):
-    distance_to_pizzerias = {}
-    for pizzeria, pizzeria_position in pizzerias.items():
-        distance_to_pizzeria = distance.distance(
-            customer_position,
-            pizzeria_position
-        ).km
-        distance_to_pizzerias[pizzeria] = round(distance_to_pizzeria, 3)
-    nearest_pizzeria = min(distance_to_pizzerias, key=distance_to_pizzerias.get)
-    return nearest_pizzeria, distance_to_pizzerias[nearest_pizzeria]
+    return get_pizzeria_index(pizzerias).nearest(customer_position)